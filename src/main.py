@@ -1,37 +1,306 @@
 import argparse
+import multiprocessing
+import random
+import signal
+import tempfile
+import threading
+import time
+from itertools import islice
 from tft.config import Config, read_config
 import coloredlogs
-from logging import info
-from tft.api import Scraper
+from logging import exception, info
+from tft.api import __REGIONS__, Scraper, for_regions, scrape_regions
+from tft.cache import DEFAULT_TTL, Cache, CachePolicy, open_cache
+from tft.ratelimit import KeyPool
+from tft.fetch import Fetcher
+from tft.queue import PriorityPolicy, WorkQueue
 from tft.data import DataExporter, DataLoader
+from tft.metrics import Metrics
+from tft.mock import MockRiotApi, percentile
 
 coloredlogs.install(level='DEBUG')
 
 config: Config
 
 
+def open_config_cache(config: Config):
+    return open_cache(config.scrape.cache_backend,
+                      config.scrape.cache_dir,
+                      config.scrape.compression,
+                      config.scrape.compression_level)
+
+
+def open_config_queue(config: Config):
+    return WorkQueue(f"{config.scrape.cache_dir}/queue.sqlite",
+                     max_attempts=config.scrape.job_attempts,
+                     backoff=config.scrape.job_backoff,
+                     max_deferrals=config.scrape.job_deferrals)
+
+
+def config_exporter(config: Config, cache: Cache):
+    return DataExporter(
+        cache=cache,
+        data_dir=config.scrape.data_dir,
+        processes=config.scrape.export_processes,
+        chunk_size=config.scrape.export_chunk_size,
+        flush_size=config.scrape.export_flush_size,
+        format=config.scrape.export_format,
+        layout=config.scrape.export_layout,
+    )
+
+
+def log_metrics(config: Config, metrics: Metrics):
+    hits = metrics.total("tft_cache_hits_total")
+    misses = metrics.total("tft_cache_misses_total")
+    info(f"{metrics.total('tft_requests_total'):.0f} requests, "
+         f"{hits / max(hits + misses, 1):.0%} cache hits, "
+         f"{metrics.total('tft_throttle_seconds_total'):.1f}s throttled, "
+         f"{metrics.total('tft_backoff_seconds_total'):.1f}s backing off")
+    if config.scrape.metrics_path:
+        metrics.write(config.scrape.metrics_path)
+
+
+def run_scrapers(config: Config, f, shared: bool = False):
+    # With shared set the rate budgets live next to the queue, so that any
+    # number of worker processes stay within the limits together
+    cache = open_config_cache(config)
+    queue = open_config_queue(config)
+    fetcher = Fetcher(
+        keys=KeyPool(config.riot.tokens or [config.riot.token],
+                     app_limits=config.scrape.app_rate_limit,
+                     shared_path=(f"{config.scrape.cache_dir}/limits.sqlite"
+                                  if shared else None)),
+        pool_size=config.scrape.pool_size,
+        timeout=config.scrape.timeout,
+        retries=config.scrape.retries,
+        backoff=config.scrape.backoff,
+        not_found_ttl=config.scrape.not_found_ttl,
+    )
+    scrapers = [
+        Scraper(
+            fetcher=fetcher,
+            region=region,
+            cache_dir=config.scrape.cache_dir,
+            cache=cache,
+            queue=queue,
+            priority=PriorityPolicy(
+                tiers=config.scrape.tier_priority,
+                unseen_games=config.scrape.unseen_games_priority,
+                recency=config.scrape.recency_priority,
+                match=config.scrape.match_priority,
+                depth=config.scrape.depth_priority,
+            ),
+            policy=CachePolicy(DEFAULT_TTL | config.scrape.cache_ttl),
+            workers=config.scrape.workers,
+            page_size=config.scrape.match_page_size,
+            max_pages=config.scrape.match_max_pages,
+            watermark_overlap=config.scrape.watermark_overlap,
+            checkpoint_every=config.scrape.checkpoint_every,
+            lease=config.scrape.lease,
+            discovery_depth=config.scrape.discovery_depth,
+            discovery_cap=config.scrape.discovery_cap,
+            discovery_capacity=config.scrape.discovery_capacity,
+            discovery_error_rate=config.scrape.discovery_error_rate,
+        )
+        for region in config.scrape.regions or [config.scrape.region]
+    ]
+    try:
+        f(scrapers)
+    finally:
+        log_metrics(config, fetcher.metrics)
+        fetcher.close()
+        queue.close()
+        cache.close()
+
+
 def scrape(args, config: Config):
-    scraper = Scraper(
-        token=config.riot.token,
-        region=config.scrape.region,
-        cache_dir=config.scrape.cache_dir,
-        sleep=config.scrape.sleep,
+    def run(scrapers):
+        scrapers[0].clean_cache()
+        scrape_regions(scrapers, config.scrape.leagues)
+
+    run_scrapers(config, run)
+
+
+def coordinate(args, config: Config):
+    def run(scrapers):
+        scrapers[0].clean_cache()
+        for_regions(scrapers, lambda s: s.enqueue(config.scrape.leagues))
+
+    run_scrapers(config, run, shared=True)
+
+
+def work_process(config: Config, follow: bool):
+    run_scrapers(
+        config,
+        lambda scrapers: for_regions(scrapers, lambda s: s.work(follow)),
+        shared=True,
     )
-    scraper.clean_cache()
-    for league in config.scrape.leagues:
-        scraper.scrape_league(league)
 
 
-def export(args, config: Config):
-    exporter = DataExporter(
-        cache_dir=config.scrape.cache_dir,
-        data_dir=config.scrape.data_dir,
+def work(args, config: Config):
+    if args.processes == 1:
+        work_process(config, args.follow)
+        return
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=work_process, args=(config, args.follow))
+                 for _ in range(args.processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+def status(args, config: Config):
+    queue = open_config_queue(config)
+    try:
+        for region, kind, state, count in queue.stats():
+            print(f"{region:6} {kind:10} {state:10} {count}")
+    finally:
+        queue.close()
+
+
+def bench(args, config: Config):
+    # Scrapes a league from a local mock server with the configured
+    # concurrency and client settings, into a throwaway cache
+    api = MockRiotApi(
+        platform=__REGIONS__[config.scrape.region].region.upper(),
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        app_limits=args.rate_limit,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        players=args.players,
+        matches_per_player=args.matches,
     )
-    exporter.export_all()
+    latencies = []
+    statuses = {}
+
+    def observe(routing, endpoint, status, seconds):
+        latencies.append(seconds)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    api.start()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            keys = KeyPool([f"BENCH-KEY-{i}" for i in range(args.keys)],
+                           app_limits=args.rate_limit)
+            fetcher = Fetcher(
+                keys=keys,
+                pool_size=config.scrape.pool_size,
+                timeout=config.scrape.timeout,
+                retries=config.scrape.retries,
+                backoff=config.scrape.backoff,
+                observe=observe,
+            )
+            cache = open_cache(config.scrape.cache_backend, cache_dir,
+                               config.scrape.compression,
+                               config.scrape.compression_level)
+            scraper = Scraper(
+                fetcher=fetcher,
+                cache_dir=cache_dir,
+                region=config.scrape.region,
+                api_url=api.url,
+                cache=cache,
+                workers=config.scrape.workers,
+                page_size=config.scrape.match_page_size,
+                max_pages=config.scrape.match_max_pages,
+            )
+            started = time.monotonic()
+            try:
+                scraper.scrape_league(args.league)
+            finally:
+                elapsed = time.monotonic() - started
+                scraper.queue.close()
+                fetcher.close()
+                cache.close()
+    finally:
+        api.stop()
+
+    print(f"requests     {len(latencies)} in {elapsed:.1f}s "
+          f"({len(latencies) / elapsed:.1f}/s)")
+    print(f"latency      p50 {percentile(latencies, 0.5) * 1000:.0f}ms "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms")
+    print(f"throttled    {keys.throttled:.1f}s over all threads")
+    print("statuses     " + " ".join(
+        f"{status}:{count}" for status, count in sorted(
+            statuses.items(), key=lambda item: str(item[0]))))
+
+
+def daemon(args, config: Config):
+    # Keeps sessions, caches and indexes warm between cycles. SIGINT or
+    # SIGTERM finish the jobs in hand, save state and exit.
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        info(f"Received {signal.Signals(signum).name}, stopping")
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    # Ladders cached for longer than a cycle would show no player moving
+    # in the next one
+    league_ttl = min(DEFAULT_TTL["league"],
+                     max(0.0, config.scrape.daemon_interval -
+                         config.scrape.daemon_jitter))
+
+    def run(scrapers):
+        exporter = config_exporter(config, scrapers[0].cache)
+        # Requests waiting on a rate limit or a backoff give up on stop
+        scrapers[0].fetcher.stop = stop
+        for s in scrapers:
+            s.stop = stop
+            if "league" not in config.scrape.cache_ttl:
+                s.policy.ttl["league"] = league_ttl
+        while not stop.is_set():
+            started = time.monotonic()
+            # A failed cycle is retried in the next one, unless no API key
+            # is left to retry with
+            try:
+                scrapers[0].clean_cache()
+                scrape_regions(scrapers, config.scrape.leagues)
+                if config.scrape.daemon_export and not stop.is_set():
+                    exporter.export_all()
+                log_metrics(config, scrapers[0].fetcher.metrics)
+            except Exception:
+                exception("Scrape cycle failed")
+                if not scrapers[0].fetcher.keys.active():
+                    raise
+
+            wait = max(0.0, config.scrape.daemon_interval -
+                       (time.monotonic() - started) +
+                       random.uniform(-config.scrape.daemon_jitter,
+                                      config.scrape.daemon_jitter))
+            if not stop.is_set():
+                info(f"Next cycle in {wait:.0f}s")
+            stop.wait(wait)
+
+    run_scrapers(config, run)
+
+
+def export(args, config: Config):
+    exporter = config_exporter(config, open_config_cache(config))
+    try:
+        exporter.export_all(full=args.full)
+    finally:
+        exporter.cache.close()
+
+
+def train_dict(args, config: Config):
+    cache = open_config_cache(config)
+    try:
+        samples = islice((m for _, m in cache.items("match")),
+                         args.samples)
+        cache.codec.train(samples, args.size)
+    finally:
+        cache.close()
 
 
 def load(args, config: Config):
-    loader = DataLoader(data_dir=config.scrape.data_dir)
+    loader = DataLoader(data_dir=config.scrape.data_dir,
+                        format=config.scrape.export_format,
+                        layout=config.scrape.export_layout)
     loader.load_all()
 
 
@@ -47,12 +316,61 @@ subparsers = parser.add_subparsers(help='sub-command help')
 p_scrape = subparsers.add_parser('scrape', help='Run scrape')
 p_scrape.set_defaults(func=scrape)
 
-p_export = subparsers.add_parser('export', help='Export json to csv')
+p_coordinate = subparsers.add_parser(
+    'coordinate', help='Queue scrape jobs for workers')
+p_coordinate.set_defaults(func=coordinate)
+
+p_work = subparsers.add_parser('work', help='Run scrape jobs from the queue')
+p_work.add_argument('--processes', type=int, default=1,
+                    help='Number of local worker processes')
+p_work.add_argument('--follow', action='store_true',
+                    help='Keep waiting for new jobs when the queue is empty')
+p_work.set_defaults(func=work)
+
+p_daemon = subparsers.add_parser(
+    'daemon', help='Scrape and export in cycles until stopped')
+p_daemon.set_defaults(func=daemon)
+
+p_status = subparsers.add_parser('status', help='Show scrape progress')
+p_status.set_defaults(func=status)
+
+p_bench = subparsers.add_parser(
+    'bench', help='Benchmark the scraper against a local mock API')
+p_bench.add_argument('--league', default='challenger')
+p_bench.add_argument('--players', type=int, default=200,
+                     help='Players on the mock ladder')
+p_bench.add_argument('--matches', type=int, default=20,
+                     help='Matches per mock player')
+p_bench.add_argument('--latency', type=float, default=0.05,
+                     help='Mock response time in seconds')
+p_bench.add_argument('--latency-jitter', type=float, default=0.02)
+p_bench.add_argument('--rate-limit', default='20:1,100:120',
+                     help='Application rate limit of each mock API key')
+p_bench.add_argument('--keys', type=int, default=1,
+                     help='Number of mock API keys')
+p_bench.add_argument('--error-rate', type=float, default=0.0,
+                     help='Share of requests failing with a 503')
+p_bench.add_argument('--throttle-rate', type=float, default=0.0,
+                     help='Share of requests refused with a service 429')
+p_bench.set_defaults(func=bench)
+
+p_export = subparsers.add_parser(
+    'export', help='Export json to csv or parquet')
+p_export.add_argument('--full', action='store_true',
+                      help='Rebuild the files rather than append new matches')
 p_export.set_defaults(func=export)
 
-p_load = subparsers.add_parser('load', help='Load csv')
+p_load = subparsers.add_parser('load', help='Load exported data')
 p_load.set_defaults(func=load)
 
+p_train_dict = subparsers.add_parser(
+    'train-dict', help='Train a compression dictionary on cached matches')
+p_train_dict.add_argument('--samples', type=int, default=2000,
+                          help='Number of matches to sample')
+p_train_dict.add_argument('--size', type=int, default=112640,
+                          help='Dictionary size in bytes')
+p_train_dict.set_defaults(func=train_dict)
+
 args = parser.parse_args()
 info(args)
 config = read_config(args.config)
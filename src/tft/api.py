@@ -1,12 +1,19 @@
-from dataclasses import dataclass
-from logging import info
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from dataclasses import dataclass, field
+from logging import error, info, warning
 from pydantic import BaseModel
-import requests
-import json
-import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlencode
 import hashlib
-import os
-import glob
+import threading
+import time
+
+from tft.bloom import BloomFilter
+from tft.cache import Cache, CachePolicy, FileCache
+from tft.fetch import Fetcher, FetchError
+from tft.queue import Job, PriorityPolicy, WorkQueue
+from tft.state import JsonState, MatchIndex
 
 
 class Region(BaseModel):
@@ -15,97 +22,403 @@ class Region(BaseModel):
 
 
 __REGIONS__ = {
-    "NA": Region(region="na1", gateway="americas"),
+    "BR": Region(region="br1", gateway="americas"),
     "CN": Region(region="cn1", gateway="asia"),
+    "EUNE": Region(region="eun1", gateway="europe"),
+    "EUW": Region(region="euw1", gateway="europe"),
+    "JP": Region(region="jp1", gateway="asia"),
+    "KR": Region(region="kr", gateway="asia"),
+    "LAN": Region(region="la1", gateway="americas"),
+    "LAS": Region(region="la2", gateway="americas"),
+    "NA": Region(region="na1", gateway="americas"),
+    "OCE": Region(region="oc1", gateway="sea"),
+    "PH": Region(region="ph2", gateway="sea"),
+    "RU": Region(region="ru", gateway="europe"),
+    "SG": Region(region="sg2", gateway="sea"),
+    "TH": Region(region="th2", gateway="sea"),
+    "TR": Region(region="tr1", gateway="europe"),
+    "TW": Region(region="tw2", gateway="sea"),
+    "VN": Region(region="vn2", gateway="sea"),
 }
 
 
 @dataclass
 class Scraper:
-    token: str
+    fetcher: Fetcher
     cache_dir: str
     region: str = "NA"
-    sleep: int = 1
+    # Where requests go, a local mock server in benchmarks
+    api_url: str = "https://{routing}.api.riotgames.com"
+    cache: Optional[Cache] = None
+    queue: Optional[WorkQueue] = None
+    priority: PriorityPolicy = field(default_factory=PriorityPolicy)
+    policy: CachePolicy = field(default_factory=CachePolicy)
+    workers: int = 1
+    page_size: int = 20
+    max_pages: int = 10
+    # Re-list this many seconds before the watermark to catch games that
+    # were still running when the player was last listed
+    watermark_overlap: int = 60 * 60
+    # Jobs finished between saves of the summoner index, watermarks and
+    # ladder snapshots
+    checkpoint_every: int = 200
+    # Seconds a worker may hold a batch of jobs before others retake it
+    lease: float = 600
+    # Queue participants of fetched matches up to this many hops from the
+    # ladder, at most discovery_cap new players per cycle
+    discovery_depth: int = 0
+    discovery_cap: int = 1000
+    # Sizes the filter of players already queued
+    discovery_capacity: int = 10_000_000
+    discovery_error_rate: float = 0.01
+    # Set to stop taking jobs, e.g. on SIGTERM
+    stop: threading.Event = field(default_factory=threading.Event)
+    match_index: MatchIndex = field(init=False, repr=False)
+    watermarks: JsonState = field(init=False, repr=False)
+    summoners: JsonState = field(init=False, repr=False)
+    snapshots: Dict[str, JsonState] = field(default_factory=dict,
+                                            init=False, repr=False)
+    visited: Optional[BloomFilter] = field(default=None, init=False,
+                                           repr=False)
+    discovered: int = field(default=0, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        if self.cache is None:
+            self.cache = FileCache(self.cache_dir)
+        if self.queue is None:
+            self.queue = WorkQueue(f"{self.cache_dir}/queue.sqlite")
+        # Match ids carry their platform, e.g. NA1_4321
+        prefix = f"{self.region_cfg().region.upper()}_"
+        self.match_index = MatchIndex(
+            f"{self.cache_dir}/matches-{self.region}.idx",
+            bootstrap=lambda: (id for id in self.cache.match_ids()
+                               if id.startswith(prefix)))
+        self.watermarks = JsonState(
+            f"{self.cache_dir}/watermarks-{self.region}.json")
+        self.summoners = JsonState(
+            f"{self.cache_dir}/summoners-{self.region}.json")
+        if self.discovery_depth > 0:
+            self.visited = BloomFilter(
+                f"{self.cache_dir}/visited-{self.region}.bloom",
+                capacity=self.discovery_capacity,
+                error_rate=self.discovery_error_rate)
 
     def clean_cache(self):
-        files = glob.glob(f"{self.cache_dir}/get-*.json")
-        for f in files:
-            info(f"Removing stale {f}")
-            os.remove(f)
+        # League pages used to be cached as "get" and refetched every run
+        self.cache.expire("get", 0)
+        for endpoint, ttl in self.policy.ttl.items():
+            if ttl is not None:
+                self.cache.expire(endpoint, ttl)
 
     def region_cfg(self) -> Region:
         return __REGIONS__[self.region]
 
+    def cached(self, key: str, max_age: Optional[float] = None):
+        # Older versions cached error bodies, e.g. of 429s, as data
+        data = self.cache.get(key, max_age)
+        if isinstance(data, dict) and "status" in data:
+            self.cache.delete(key)
+            return None
+        return data
+
     def __get__(
         self,
         routing: str,
         path: str,
-        cache_key: str = "get",
+        endpoint: str,
         skip_read: bool = False,
+        match_id: Optional[str] = None,
     ):
-        url = f"https://{routing}.api.riotgames.com/{path}"
+        url = f"{self.api_url.format(routing=routing)}/{path}"
         hash = hashlib.md5(url.encode("utf-8")).hexdigest()
-        fname = f"{cache_key}-{hash}.json"
-        fpath = f"{self.cache_dir}/{fname}"
+        key = f"{endpoint}-{hash}"
 
-        if os.path.exists(fpath):
-            if skip_read:
-                info(f"Skipping {fpath} (already exists)")
+        metrics = self.fetcher.metrics
+        labels = {"region": self.region, "endpoint": endpoint}
+        if skip_read:
+            # Match jobs are only queued for ids missing from the index,
+            # so reading the entry to check it is rare
+            if self.cached(key) is not None:
+                info(f"Skipping {key} (already exists)")
+                metrics.inc("tft_cache_hits_total", **labels)
+                if match_id:
+                    self.match_index.add(match_id)
                 return None
-
-            with open(fpath, 'r') as f:
-                info(f"Reading {fpath}")
-                data = json.loads(f.read())
+        else:
+            data = self.cached(key, self.policy.max_age(endpoint))
+            if data is not None:
+                metrics.inc("tft_cache_hits_total", **labels)
                 return data
+        metrics.inc("tft_cache_misses_total", **labels)
 
-        headers = {"X-Riot-Token": self.token}
-        resp = requests.get(url, headers=headers)
-        data = resp.json()
-
-        with open(fpath, 'w') as f:
-            info(f"Writing {fpath}")
-            json.dump(data, f)
-
-        time.sleep(self.sleep)
+        # Only successful responses reach the cache, 404s come back as None
+        data = self.fetcher.get(routing, url, endpoint, region=self.region)
+        if data is not None:
+            self.cache.put(key, endpoint, data, match_id=match_id)
+            if match_id:
+                self.match_index.add(match_id)
         return data
 
     def get_league(self, league: str):
-        return self.__get__(self.region_cfg().region,
-                            f"tft/league/v1/{league}")
+        return self.__get__(
+            self.region_cfg().region,
+            f"tft/league/v1/{league}",
+            endpoint="league",
+        )
 
     def get_summoner(self, id: str):
         return self.__get__(
             self.region_cfg().region,
             f"tft/summoner/v1/summoners/{id}",
-            cache_key="summoner",
+            endpoint="summoner",
         )
 
-    def get_matches_for(self, puuid: str):
-        return self.__get__(
-            self.region_cfg().gateway,
-            f"tft/match/v1/matches/by-puuid/{puuid}/ids",
-            cache_key="summoner",
-        )
+    def get_matches_for(self, puuid: str, watermark: bool = True):
+        # Only list games since the player's watermark, paging deeper when
+        # they played more than a page since. Without a watermark take the
+        # latest page only.
+        since = self.watermarks.get(puuid) if watermark else None
+        listed_at = int(time.time())
+        ids = []
+        for page in range(self.max_pages if since else 1):
+            query = {"start": page * self.page_size, "count": self.page_size}
+            if since:
+                query["startTime"] = since - self.watermark_overlap
+            page_ids = self.__get__(
+                self.region_cfg().gateway,
+                f"tft/match/v1/matches/by-puuid/{puuid}/ids?"
+                f"{urlencode(query)}",
+                endpoint="match-ids",
+            ) or []
+            ids.extend(page_ids)
+            if len(page_ids) < self.page_size:
+                break
+
+        if watermark:
+            self.watermarks.set(puuid, listed_at)
+        return ids
 
     def get_match(self, id: str):
         return self.__get__(
             self.region_cfg().gateway,
             f"tft/match/v1/matches/{id}",
-            cache_key="match",
+            endpoint="match",
             skip_read=True,
+            match_id=id,
         )
 
+    def get_puuid(self, id: str) -> Optional[str]:
+        # puuids never change, only look up summoners we have not seen
+        if id not in self.summoners:
+            summoner_data = self.get_summoner(id)
+            if summoner_data is None:
+                return None
+            self.summoners.set(id, {
+                "puuid": summoner_data["puuid"],
+                "name": summoner_data.get("name"),
+                "level": summoner_data.get("summonerLevel"),
+            })
+        return self.summoners.get(id)["puuid"]
+
+    def get_summoner_matches(self, id: str) -> List[str]:
+        puuid = self.get_puuid(id)
+        return self.get_matches_for(puuid) if puuid else []
+
+    def snapshot(self, league: str) -> JsonState:
+        # Games played per summonerId when their matches were last listed
+        with self._lock:
+            if league not in self.snapshots:
+                self.snapshots[league] = JsonState(
+                    f"{self.cache_dir}/league-{self.region}-{league}.json")
+            return self.snapshots[league]
+
+    def checkpoint(self):
+        self.summoners.save()
+        self.watermarks.save()
+        for snapshot in self.snapshots.values():
+            snapshot.save()
+
+    def push_matches(self, matches_ids: List[str], league: Optional[str],
+                     depth: int = 0):
+        # Listings come newest first
+        self.queue.push(self.region, "match", [
+            (id, {"depth": depth},
+             self.priority.for_match(league, position, depth))
+            for position, id in enumerate(dict.fromkeys(matches_ids))
+            if id not in self.match_index
+        ], refresh=False)
+
+    def list_summoner(self, job: Job):
+        puuid = self.get_puuid(job.key)
+        matches_ids = self.get_matches_for(puuid) if puuid else []
+        # Ladder players are listed here, never as discovered players
+        if puuid and self.visited is not None:
+            self.visited.add(puuid)
+        league = job.payload["league"]
+        self.push_matches(matches_ids, league)
+        self.snapshot(league).set(job.key, job.payload["games"])
+
+    def list_player(self, job: Job):
+        # Discovered players are listed once, a watermark per player would
+        # only grow the state saved at every checkpoint
+        matches_ids = self.get_matches_for(job.key, watermark=False)
+        self.push_matches(matches_ids, None, job.payload["depth"])
+
+    def discover(self, match, depth: int):
+        # Participants of a match `depth` hops from the ladder are one hop
+        # further. The filter can mistake a new player for a seen one, who
+        # is then skipped, but never queues a player twice.
+        if self.visited is None or depth >= self.discovery_depth:
+            return
+        players = []
+        for puuid in match["metadata"]["participants"]:
+            with self._lock:
+                if self.discovered >= self.discovery_cap:
+                    break
+                if not self.visited.add(puuid):
+                    continue
+                self.discovered += 1
+            players.append((puuid, {"depth": depth + 1},
+                            self.priority.for_player(depth + 1)))
+        self.queue.push(self.region, "player", players, refresh=False)
+
+    def fetch_match(self, job: Job):
+        match = self.get_match(job.key)
+        # Match jobs queued by older versions have no payload
+        if match is not None:
+            self.discover(match, (job.payload or {}).get("depth", 0))
+
+    def handle(self, job: Job):
+        if job.kind == "summoner":
+            self.list_summoner(job)
+        elif job.kind == "player":
+            self.list_player(job)
+        else:
+            self.fetch_match(job)
+
+    def finish(self, job: Job, future: Future):
+        try:
+            future.result()
+        except FetchError as e:
+            action = ("fetch match" if job.kind == "match"
+                      else "list matches of")
+            error(f"Could not {action} {job.key}: {e.reason}")
+            self.queue.fail(job, e.retry_after)
+        else:
+            self.queue.done(job)
+
+    def drain(self):
+        # Jobs of any kind are taken by priority, so matches are fetched as
+        # soon as they are listed rather than after every player. Each
+        # worker takes the next job as soon as it is free, so a job waiting
+        # on a Retry-After does not hold up the others.
+        finished = 0
+        running: Dict[Future, Job] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                if not self.stop.is_set():
+                    for job in self.queue.take(self.workers - len(running),
+                                               self.region,
+                                               lease=self.lease):
+                        running[pool.submit(self.handle, job)] = job
+                if not running:
+                    # Wait for jobs backing off after a failure
+                    due = self.queue.next_due(self.region)
+                    if due is None or self.stop.is_set():
+                        break
+                    self.stop.wait(due)
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    # Jobs are marked done right away but state is only
+                    # saved every checkpoint_every jobs. A crash loses the
+                    # summoners, watermarks and snapshots since, which
+                    # costs lookups and relistings in the next run.
+                    finished += 1
+                    if finished >= self.checkpoint_every:
+                        self.checkpoint()
+                        finished = 0
+                    self.finish(job, future)
+
+    def enqueue_league(self, league: str):
+        # Queue players whose game count moved since the last snapshot, or
+        # who are new to the ladder
+        try:
+            league_data = self.get_league(league)
+        except FetchError as e:
+            error(f"Could not get {league} league: {e.reason}")
+            return
+        if league_data is None:
+            warning(f"No {league} league in {self.region}")
+            return
+        snapshot = self.snapshot(league)
+        entries = [(entry["summonerId"],
+                    {"league": league,
+                     "games": entry["wins"] + entry["losses"]})
+                   for entry in league_data["entries"]]
+        active = []
+        for id, payload in entries:
+            seen = snapshot.get(id)
+            if seen == payload["games"]:
+                continue
+            unseen = (payload["games"] - seen if seen is not None
+                      else self.page_size)
+            active.append((id, payload,
+                           self.priority.for_summoner(league, unseen)))
+        info(f"{len(active)} of {len(entries)} players in {league} "
+             f"played since the last scrape")
+        self.queue.push(self.region, "summoner", active)
+
+    def run_queue(self):
+        self.drain()
+        self.checkpoint()
+        # The filter is written whole, so only once per run. Losing it in a
+        # crash only pushes some players again, which the queue ignores.
+        if self.visited is not None:
+            self.visited.save()
+
+    def enqueue(self, leagues: List[str]):
+        # A new cycle, discovery may queue another discovery_cap players
+        self.discovered = 0
+        self.queue.retry_failed(self.region)
+        for league in leagues:
+            self.enqueue_league(league)
+
+    def work(self, follow: bool = False, poll: float = 2):
+        # Worker mode: other processes may share the queue, so jobs they
+        # left in flight are only picked up once their lease runs out
+        while not self.stop.is_set():
+            self.run_queue()
+            if not self.queue.pending(self.region):
+                # The cycle's jobs are done, as far as this worker knows
+                self.discovered = 0
+                if not follow:
+                    return
+            self.stop.wait(poll)
+
     def scrape_league(self, league: str):
-        league_data = self.get_league(league)
-        summoners = list(map(lambda d: d["summonerId"],
-                             league_data["entries"]))
-        info(len(summoners))
-        all_matches = []
-        for summoner in summoners:
-            summoner_data = self.get_summoner(summoner)
-            matches_ids = self.get_matches_for(summoner_data["puuid"])
-            all_matches.extend(matches_ids)
-
-        info(f"Scraping {len(all_matches)} matches")
-        for match_id in all_matches:
-            self.get_match(match_id)
+        self.scrape([league])
+
+    def scrape(self, leagues: List[str]):
+        # Single process mode, anything left in flight belongs to a run
+        # that died and is finished first
+        self.queue.recover(self.region)
+        self.enqueue(leagues)
+        self.run_queue()
+
+
+def for_regions(scrapers: List[Scraper], f: Callable[[Scraper], None]):
+    # Regions share a Fetcher, whose key pool budgets each platform and
+    # gateway host separately, so every region runs at its own limits
+    with ThreadPoolExecutor(max_workers=len(scrapers)) as pool:
+        futures = [pool.submit(f, s) for s in scrapers]
+        for future in futures:
+            future.result()
+
+
+def scrape_regions(scrapers: List[Scraper], leagues: List[str]):
+    for_regions(scrapers, lambda s: s.scrape(leagues))
@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from logging import info
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import threading
+
+HEADER = struct.Struct("<QQ")
+
+
+@dataclass
+class BloomFilter:
+    # Answers "seen before?" in a fixed amount of memory, wrongly saying
+    # yes for about error_rate of unseen keys once it holds capacity keys
+    path: str
+    capacity: int = 10_000_000
+    error_rate: float = 0.01
+    size: int = field(init=False)
+    hashes: int = field(init=False)
+    bits: bytearray = field(init=False, repr=False)
+    dirty: bool = field(default=False, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        self.size = math.ceil(-self.capacity * math.log(self.error_rate) /
+                              math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        on_disk = self.read()
+        if on_disk is not None:
+            info(f"Loaded {self.path}")
+        self.bits = bytearray(on_disk or bytes((self.size + 7) // 8))
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            size, hashes = HEADER.unpack(f.read(HEADER.size))
+            if (size, hashes) != (self.size, self.hashes):
+                raise ValueError(f"{self.path} was built for a different "
+                                 f"capacity or error rate")
+            return f.read()
+
+    def positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self.positions(key))
+
+    def add(self, key: str) -> bool:
+        # Returns whether the key was new
+        with self._lock:
+            new = False
+            for p in self.positions(key):
+                if not self.bits[p >> 3] & (1 << (p & 7)):
+                    self.bits[p >> 3] |= 1 << (p & 7)
+                    new = True
+            self.dirty = self.dirty or new
+            return new
+
+    def save(self):
+        # Filters merge with a bitwise or, so processes sharing the file
+        # keep each other's keys
+        with self._lock:
+            if not self.dirty:
+                return
+            with open(f"{self.path}.lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                on_disk = self.read()
+                if on_disk is not None:
+                    merged = (int.from_bytes(self.bits, "little") |
+                              int.from_bytes(on_disk, "little"))
+                    self.bits = bytearray(merged.to_bytes(len(self.bits),
+                                                          "little"))
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(HEADER.pack(self.size, self.hashes))
+                    f.write(self.bits)
+                os.replace(tmp, self.path)
+                self.dirty = False
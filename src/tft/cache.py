@@ -0,0 +1,278 @@
+from dataclasses import dataclass, field
+from logging import info
+from typing import Any, Container, Dict, Iterator, Optional, Tuple
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+from tft.codec import Codec
+
+
+# Seconds an endpoint's entries stay fresh, None never expires
+DEFAULT_TTL: Dict[str, Optional[float]] = {
+    "league": 60 * 60,
+    "summoner": 7 * 24 * 60 * 60,
+    "match-ids": 60 * 60,
+    "match": None,
+}
+
+
+@dataclass
+class CachePolicy:
+    ttl: Dict[str, Optional[float]] = field(
+        default_factory=lambda: dict(DEFAULT_TTL))
+
+    def max_age(self, endpoint: str) -> Optional[float]:
+        return self.ttl.get(endpoint)
+
+
+class Cache:
+    codec: Codec
+
+    def get(self, key: str,
+            max_age: Optional[float] = None) -> Optional[Any]:
+        raise NotImplementedError
+
+    def __contains__(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def put(self, key: str, endpoint: str, data: Any,
+            match_id: Optional[str] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def count(self, endpoint: str) -> int:
+        raise NotImplementedError
+
+    def raw_items(self, endpoint: str,
+                  skip: Container[str] = ()) -> Iterator[Tuple[str, bytes]]:
+        # Entries as stored by key, for decoding elsewhere with codec.decode.
+        # Keys are the same in every backend.
+        raise NotImplementedError
+
+    def items(self, endpoint: str,
+              skip: Container[str] = ()) -> Iterator[Tuple[str, Any]]:
+        # Keys in skip are left out before their data is decoded
+        for key, raw in self.raw_items(endpoint, skip):
+            yield (key, self.codec.decode(raw))
+
+    def match_ids(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def expire(self, endpoint: str, max_age: float):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+@dataclass
+class FileCache(Cache):
+    cache_dir: str
+    codec: Optional[Codec] = None
+
+    def __post_init__(self):
+        if self.codec is None:
+            self.codec = Codec(f"{self.cache_dir}/dicts")
+
+    def find(self, key: str) -> Optional[str]:
+        for ext in (".json", ".json.zst"):
+            fpath = f"{self.cache_dir}/{key}{ext}"
+            if os.path.exists(fpath):
+                return fpath
+        return None
+
+    def read_raw(self, fpath: str) -> bytes:
+        with open(fpath, 'rb') as f:
+            return f.read()
+
+    def read(self, fpath: str) -> Any:
+        return self.codec.decode(self.read_raw(fpath))
+
+    def expired(self, fpath: str, max_age: Optional[float]) -> bool:
+        if max_age is None:
+            return False
+        return os.path.getmtime(fpath) < time.time() - max_age
+
+    def get(self, key: str,
+            max_age: Optional[float] = None) -> Optional[Any]:
+        fpath = self.find(key)
+        if fpath is None or self.expired(fpath, max_age):
+            return None
+
+        info(f"Reading {fpath}")
+        return self.read(fpath)
+
+    def __contains__(self, key: str) -> bool:
+        return self.find(key) is not None
+
+    def put(self, key: str, endpoint: str, data: Any,
+            match_id: Optional[str] = None):
+        fpath = f"{self.cache_dir}/{key}{self.codec.ext}"
+        with open(fpath, 'wb') as f:
+            info(f"Writing {fpath}")
+            f.write(self.codec.encode(data))
+
+    def delete(self, key: str):
+        while (fpath := self.find(key)) is not None:
+            info(f"Removing {fpath}")
+            os.remove(fpath)
+
+    def files(self, endpoint: str):
+        # Keep "match" from also picking up "match-ids-*" files
+        prefix = len(f"{self.cache_dir}/{endpoint}-")
+        return [f for f in glob.glob(f"{self.cache_dir}/{endpoint}-*.json*")
+                if "-" not in f[prefix:]]
+
+    def count(self, endpoint: str) -> int:
+        return len(self.files(endpoint))
+
+    def key(self, fpath: str) -> str:
+        # match-<hash>.json.zst -> match-<hash>
+        return os.path.basename(fpath).split(".")[0]
+
+    def raw_items(self, endpoint: str,
+                  skip: Container[str] = ()) -> Iterator[Tuple[str, bytes]]:
+        for fname in self.files(endpoint):
+            key = self.key(fname)
+            if key not in skip:
+                yield (key, self.read_raw(fname))
+
+    def match_ids(self) -> Iterator[str]:
+        for _, m in self.items("match"):
+            if "metadata" in m:
+                yield m["metadata"]["match_id"]
+
+    def expire(self, endpoint: str, max_age: float):
+        for f in self.files(endpoint):
+            if self.expired(f, max_age):
+                info(f"Removing stale {f}")
+                os.remove(f)
+
+
+@dataclass
+class SqliteCache(Cache):
+    path: str
+    codec: Codec
+    conn: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        # Worker processes may share the file, wait for each other's writes
+        # as long as the queue does
+        self.conn = sqlite3.connect(self.path, timeout=60,
+                                    check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                match_id TEXT,
+                data BLOB NOT NULL,
+                fetched_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS entries_endpoint
+                ON entries (endpoint);
+            CREATE INDEX IF NOT EXISTS entries_match_id
+                ON entries (match_id);
+        """)
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(entries)")]
+        if "fetched_at" not in columns:
+            self.conn.execute("ALTER TABLE entries "
+                              "ADD COLUMN fetched_at REAL NOT NULL DEFAULT 0")
+
+    def get(self, key: str,
+            max_age: Optional[float] = None) -> Optional[Any]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data, fetched_at FROM entries WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        if max_age is not None and row[1] < time.time() - max_age:
+            return None
+        info(f"Reading {key}")
+        return self.codec.decode(row[0])
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def put(self, key: str, endpoint: str, data: Any,
+            match_id: Optional[str] = None):
+        info(f"Writing {key}")
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, endpoint, match_id, self.codec.encode(data),
+                 time.time()))
+
+    def delete(self, key: str):
+        info(f"Removing {key}")
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def count(self, endpoint: str) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE endpoint = ?",
+                (endpoint,)).fetchone()[0]
+
+    def rows(self, query: str, params: tuple, batch: int = 1000):
+        # Separate connection so long scans do not block writers
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def raw_items(self, endpoint: str,
+                  skip: Container[str] = ()) -> Iterator[Tuple[str, bytes]]:
+        for key, data in self.rows(
+                "SELECT key, data FROM entries WHERE endpoint = ?",
+                (endpoint,)):
+            if key not in skip:
+                yield (key, data)
+
+    def match_ids(self) -> Iterator[str]:
+        for (match_id,) in self.rows(
+                "SELECT match_id FROM entries WHERE match_id IS NOT NULL",
+                ()):
+            yield match_id
+
+    def expire(self, endpoint: str, max_age: float):
+        with self._lock, self.conn:
+            removed = self.conn.execute(
+                "DELETE FROM entries WHERE endpoint = ? AND fetched_at < ?",
+                (endpoint, time.time() - max_age)).rowcount
+        if removed:
+            info(f"Removed {removed} stale {endpoint} entries")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def open_cache(backend: str, cache_dir: str,
+               compression: Optional[str] = None,
+               compression_level: int = 3) -> Cache:
+    codec = Codec(f"{cache_dir}/dicts", compression, compression_level)
+    if backend == "file":
+        return FileCache(cache_dir, codec)
+    if backend == "sqlite":
+        return SqliteCache(f"{cache_dir}/cache.sqlite", codec)
+    raise ValueError(f"Unknown cache backend {backend}")
@@ -0,0 +1,100 @@
+from dataclasses import dataclass, field
+from logging import info
+from typing import Any, Dict, Iterable, Optional, Union
+import glob
+import json
+import os
+import threading
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression needs the zstandard package, "
+                           "install with `poetry install -E zstd`")
+    return zstandard
+
+
+@dataclass
+class Codec:
+    # Trained dictionaries live in dict_dir as {dict_id}.zdict, the newest
+    # one is used for writes and any of them can be used for reads
+    dict_dir: str
+    compression: Optional[str] = None
+    level: int = 3
+    dicts: Dict[int, Any] = field(default_factory=dict, init=False,
+                                  repr=False)
+    write_dict: Optional[Any] = field(default=None, init=False, repr=False)
+    _local: threading.local = field(default_factory=threading.local,
+                                    init=False, repr=False)
+
+    def __post_init__(self):
+        if self.compression not in (None, "zstd"):
+            raise ValueError(f"Unknown compression {self.compression}")
+        if self.compression:
+            zstd()
+        paths = sorted(glob.glob(f"{self.dict_dir}/*.zdict"),
+                       key=os.path.getmtime)
+        if paths:
+            self.write_dict = self.load_dict(paths[-1])
+
+    @property
+    def ext(self) -> str:
+        return ".json.zst" if self.compression else ".json"
+
+    def load_dict(self, path: str):
+        with open(path, 'rb') as f:
+            d = zstd().ZstdCompressionDict(f.read())
+        self.dicts[d.dict_id()] = d
+        info(f"Loaded compression dictionary {path}")
+        return d
+
+    def get_dict(self, dict_id: int):
+        if dict_id not in self.dicts:
+            self.load_dict(f"{self.dict_dir}/{dict_id}.zdict")
+        return self.dicts[dict_id]
+
+    def compressor(self):
+        # zstandard (de)compressors must not be shared between threads
+        if getattr(self._local, "compressor", None) is None:
+            self._local.compressor = zstd().ZstdCompressor(
+                level=self.level, dict_data=self.write_dict)
+        return self._local.compressor
+
+    def decompressor(self, dict_id: int):
+        if getattr(self._local, "decompressors", None) is None:
+            self._local.decompressors = {}
+        decompressors = self._local.decompressors
+        if dict_id not in decompressors:
+            d = self.get_dict(dict_id) if dict_id else None
+            decompressors[dict_id] = zstd().ZstdDecompressor(dict_data=d)
+        return decompressors[dict_id]
+
+    def encode(self, data: Any) -> bytes:
+        raw = json.dumps(data).encode("utf-8")
+        if not self.compression:
+            return raw
+        return self.compressor().compress(raw)
+
+    def decode(self, raw: Union[str, bytes]) -> Any:
+        if isinstance(raw, bytes) and raw[:4] == ZSTD_MAGIC:
+            dict_id = zstd().get_frame_parameters(raw).dict_id
+            raw = self.decompressor(dict_id).decompress(raw)
+        return json.loads(raw)
+
+    def train(self, samples: Iterable[Any], size: int = 112640) -> str:
+        z = zstd()
+        d = z.train_dictionary(
+            size, [json.dumps(s).encode("utf-8") for s in samples])
+        os.makedirs(self.dict_dir, exist_ok=True)
+        path = f"{self.dict_dir}/{d.dict_id()}.zdict"
+        with open(path, 'wb') as f:
+            f.write(d.as_bytes())
+        info(f"Wrote compression dictionary {path}")
+        self.dicts[d.dict_id()] = d
+        self.write_dict = d
+        self._local = threading.local()
+        return path
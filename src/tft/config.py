@@ -1,18 +1,76 @@
 import yaml
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Optional
 
 
 class ScrapeConfig(BaseModel):
-    region: str
+    region: str = "NA"
+    # Scraped concurrently, overrides region when set
+    regions: List[str] = []
     cache_dir: str
+    cache_backend: str = "file"
+    compression: Optional[str] = None
+    compression_level: int = 3
+    cache_ttl: Dict[str, Optional[int]] = {}
+    match_page_size: int = 20
+    match_max_pages: int = 10
+    watermark_overlap: int = 3600
+    checkpoint_every: int = 200
+    job_attempts: int = 3
+    # Seconds before a failed job is retried, doubling with every attempt
+    job_backoff: float = 30
+    # Times a job may wait for an open circuit or a refusing service
+    # before attempts count again
+    job_deferrals: int = 20
+    lease: float = 600
+    tier_priority: Dict[str, float] = {
+        "challenger": 3,
+        "grandmaster": 2,
+        "master": 1,
+    }
+    unseen_games_priority: float = 0.1
+    recency_priority: float = 1.0
+    match_priority: float = 1.0
+    depth_priority: float = 1.0
+    # Hops from the ladder to discover players through, 0 turns it off
+    discovery_depth: int = 0
+    discovery_cap: int = 1000
+    discovery_capacity: int = 10_000_000
+    discovery_error_rate: float = 0.01
     data_dir: str
-    sleep: int
+    # Processes parsing matches on export, every core when unset
+    export_processes: Optional[int] = None
+    export_chunk_size: int = 200
+    # Matches buffered per write, each write adds a Parquet file per table
+    # and partition
+    export_flush_size: int = 5000
+    # csv, or parquet partitioned by set and day
+    export_format: str = "csv"
+    # flat repeats match and player columns in every table, star keeps
+    # them in their own tables and refers to them by integer keys
+    export_layout: str = "flat"
+    workers: int = 1
+    app_rate_limit: str = "20:1,100:120"
+    pool_size: int = 10
+    timeout: float = 10
+    retries: int = 5
+    backoff: float = 0.5
+    not_found_ttl: float = 600
+    # Written after each run, Prometheus text format for a .prom file and
+    # JSON otherwise. {pid} keeps worker processes apart.
+    metrics_path: Optional[str] = None
+    # Seconds between the starts of daemon cycles, give or take up to
+    # daemon_jitter
+    daemon_interval: float = 1800
+    daemon_jitter: float = 60
+    daemon_export: bool = True
     leagues: List[str]
 
 
 class RiotConfig(BaseModel):
-    token: str
+    token: Optional[str] = None
+    # Keys of the same Riot application, encrypted ids differ across apps
+    tokens: List[str] = []
 
 
 class Config(BaseModel):
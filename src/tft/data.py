@@ -1,118 +1,597 @@
-import glob
-import json
 import pandas as pd
 import numpy as np
+import json
+import multiprocessing
+import os
+import shutil
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 from logging import info, error
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from tqdm import tqdm
 
+from tft.cache import Cache
+from tft.codec import Codec
+from tft.state import JsonState, MatchIndex
+
+TABLES = ["matches", "participants", "augments", "traits", "units", "items"]
+
+FORMATS = ["csv", "parquet"]
+
+# The star layout replaces strings with integer keys. Matches, participants
+# and units are numbered in export order, players and names (augments,
+# traits, characters and items) are looked up in their own tables.
+LAYOUTS = ["flat", "star"]
+STAR_TABLES = ["players", "names"] + TABLES
+STAR_KEYS = {
+    'matches': 'match_key',
+    'participants': 'participant_key',
+    'units': 'unit_key',
+}
+STAR_NAMES = {
+    'augment': 'augment_key',
+    'trait': 'trait_key',
+    'character_id': 'character_key',
+    'character_name': 'character_name_key',
+    'item': 'item_key',
+}
+
+# Parquet files are split into directories by these
+PARTITIONS = ["tft_set_name", "match_date"]
+
+# Each export adds a Parquet file per table and partition. Once a directory
+# holds more than COMPACT_FILES files under COMPACT_BYTES, they are merged.
+COMPACT_FILES = 8
+COMPACT_BYTES = 64 * 1024 * 1024
+
+# Arrow type of each exported column
+COLUMN_TYPES = {
+    'match_id': 'string',
+    'match_datetime': 'timestamp[ms]',
+    'match_length': 'float32',
+    'tft_set_number': 'int16',
+    'tft_set_name': 'string',
+    'match_date': 'string',
+    'puuid': 'string',
+    'placement': 'int8',
+    'level': 'int8',
+    'total_damage_to_players': 'int16',
+    'last_round': 'int16',
+    'augment': 'string',
+    'trait': 'string',
+    'num_units': 'int8',
+    'style': 'int8',
+    'tier_current': 'int8',
+    'tier_total': 'int8',
+    'character_id': 'string',
+    'character_name': 'string',
+    'rarity': 'int8',
+    'tier': 'int8',
+    'item': 'string',
+    'match_key': 'int32',
+    'participant_key': 'int64',
+    'unit_key': 'int64',
+    'player_key': 'int32',
+    'name_key': 'int32',
+    'name': 'string',
+    'augment_key': 'int32',
+    'trait_key': 'int32',
+    'character_key': 'int32',
+    'character_name_key': 'int32',
+    'item_key': 'int32',
+}
+
+
+def arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("parquet exports need the pyarrow package, "
+                           "install with `poetry install -E parquet`")
+    return pyarrow, pyarrow.parquet
+
+
+def read_table(path: str, format: str,
+               keep_default_na: bool = True) -> Optional[pd.DataFrame]:
+    # A whole exported table, None when nothing was written yet. Without
+    # keep_default_na, empty strings in CSV stay strings.
+    if not os.path.exists(path):
+        return None
+    if format == "parquet":
+        _, pq = arrow()
+        return pq.read_table(path).to_pandas()
+    return pd.read_csv(path, keep_default_na=keep_default_na)
+
 
 def select_keys(coll, keys, rename=dict()):
     return dict((rename.get(k, k), v) for k, v in coll.items() if k in keys)
 
 
+def flatten_match(m) -> Dict[str, List[dict]]:
+    rows = {t: [] for t in TABLES}
+    match = {
+        'match_id': m['metadata']['match_id'],
+        'match_datetime': m['info']['game_datetime'],
+        'match_length': m['info']['game_length'],
+        'tft_set_number': m['info']['tft_set_number'],
+        'tft_set_name': m['info']['tft_set_core_name'],
+    }
+    rows["matches"].append(match)
+
+    for p in m['info']['participants']:
+        participant = select_keys(p, [
+            'puuid',
+            'placement',
+        ])
+        participant_data = select_keys(p, [
+            'level',
+            'total_damage_to_players',
+            'last_round',
+        ])
+        rows["participants"].append(participant_data | participant | match)
+
+        for a in p['augments']:
+            rows["augments"].append({'augment': a} | participant | match)
+
+        for t in p['traits']:
+            trait = select_keys(t, [
+                'name',
+                'num_units',
+                'style',
+                'tier_current',
+                'tier_total',
+            ], {'name': 'trait'})
+            rows["traits"].append(trait | participant | match)
+
+        for u in p['units']:
+            unit = select_keys(u, [
+                'character_id',
+            ])
+            unit_data = select_keys(u, [
+                'name',
+                'rarity',
+                'tier',
+            ], {'name': 'character_name'})
+            rows["units"].append(unit | unit_data | participant | match)
+
+            for i in u['itemNames']:
+                rows["items"].append({'item': i} | unit | participant | match)
+    return rows
+
+
+def normalize_match(m, base: Dict[str, int]) -> Dict[str, List[dict]]:
+    # Keys count on from base, the number of rows before this match in its
+    # chunk. The exporter shifts them past the keys of earlier chunks.
+    rows = {t: [] for t in TABLES}
+    match_key = base['matches']
+    rows["matches"].append({
+        'match_key': match_key,
+        'match_id': m['metadata']['match_id'],
+        'match_datetime': m['info']['game_datetime'],
+        'match_length': m['info']['game_length'],
+        'tft_set_number': m['info']['tft_set_number'],
+        'tft_set_name': m['info']['tft_set_core_name'],
+    })
+
+    for p in m['info']['participants']:
+        participant_key = base['participants'] + len(rows["participants"])
+        rows["participants"].append(
+            {'participant_key': participant_key, 'match_key': match_key} |
+            select_keys(p, [
+                'puuid',
+                'placement',
+                'level',
+                'total_damage_to_players',
+                'last_round',
+            ]))
+
+        for a in p['augments']:
+            rows["augments"].append(
+                {'participant_key': participant_key, 'augment': a})
+
+        for t in p['traits']:
+            rows["traits"].append(
+                {'participant_key': participant_key} |
+                select_keys(t, [
+                    'name',
+                    'num_units',
+                    'style',
+                    'tier_current',
+                    'tier_total',
+                ], {'name': 'trait'}))
+
+        for u in p['units']:
+            unit_key = base['units'] + len(rows["units"])
+            rows["units"].append(
+                {'unit_key': unit_key, 'participant_key': participant_key} |
+                select_keys(u, [
+                    'character_id',
+                    'name',
+                    'rarity',
+                    'tier',
+                ], {'name': 'character_name'}))
+
+            for i in u['itemNames']:
+                rows["items"].append({'unit_key': unit_key, 'item': i})
+    return rows
+
+
+def to_columns(rows: List[dict]) -> Dict[str, list]:
+    # Column lists pickle far smaller than one dict per row
+    columns: Dict[str, list] = {}
+    for n, row in enumerate(rows):
+        for k, v in row.items():
+            if k not in columns:
+                columns[k] = [None] * n
+            columns[k].append(v)
+        for column in columns.values():
+            if len(column) == n:
+                column.append(None)
+    return columns
+
+
+_codec: Optional[Codec] = None
+
+
+def init_worker(dict_dir: str):
+    global _codec
+    _codec = Codec(dict_dir)
+
+
+def flatten_chunk(layout: str, chunk: List[Tuple[str, bytes]]):
+    # Runs in the export processes, decoding is most of the work
+    rows = {t: [] for t in TABLES}
+    for fname, raw in chunk:
+        try:
+            m = _codec.decode(raw)
+            # Error bodies cached by older versions of the scraper
+            if "status" in m:
+                continue
+            if layout == "star":
+                base = {t: len(rows[t]) for t in STAR_KEYS}
+                match_rows = normalize_match(m, base)
+            else:
+                match_rows = flatten_match(m)
+            for t, r in match_rows.items():
+                rows[t] += r
+        except Exception as e:
+            error(f"Colud not process {fname}")
+            error(e)
+    return {t: to_columns(r) for t, r in rows.items()}
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
 @dataclass
 class DataExporter:
-    cache_dir: str
+    cache: Cache
     data_dir: str
+    # None uses every core
+    processes: Optional[int] = None
+    chunk_size: int = 200
+    # Matches held in memory between writes
+    flush_size: int = 5000
+    # Parquet writes a directory of files per table, partitioned by set
+    # and day, with one file per write and partition
+    format: str = "csv"
+    layout: str = "flat"
+    # Cache keys of the matches already in the exported files, the same
+    # whichever backend or spelling of cache_dir they were read from
+    manifest: MatchIndex = field(init=False, repr=False)
+    # Next match, participant and unit key of the star layout
+    keys: JsonState = field(init=False, repr=False)
+    # How to undo the write in progress, see flush
+    journal: str = field(init=False, repr=False)
+    # Player and name keys of the star layout by string
+    dims: Dict[str, Dict[str, int]] = field(default_factory=dict,
+                                            init=False, repr=False)
+
+    def __post_init__(self):
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown export format {self.format}")
+        if self.layout not in LAYOUTS:
+            raise ValueError(f"Unknown export layout {self.layout}")
+        if self.format == "parquet":
+            arrow()
+        os.makedirs(self.root, exist_ok=True)
+        suffix = "" if self.format == "csv" else f"-{self.format}"
+        self.manifest = MatchIndex(f"{self.root}/exported{suffix}.idx")
+        self.keys = JsonState(f"{self.root}/keys{suffix}.json")
+        self.journal = f"{self.root}/journal{suffix}.json"
+
+    @property
+    def root(self) -> str:
+        # Star tables share names with flat ones
+        if self.layout == "star":
+            return f"{self.data_dir}/star"
+        return self.data_dir
+
+    @property
+    def tables(self) -> List[str]:
+        return STAR_TABLES if self.layout == "star" else TABLES
+
+    def reset(self):
+        for path in [self.manifest.path, self.keys.path, self.journal] + \
+                [self.path(t) for t in self.tables]:
+            if os.path.isdir(path):
+                info(f"Removing {path}")
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                info(f"Removing {path}")
+                os.remove(path)
+        self.manifest = MatchIndex(self.manifest.path)
+        self.keys = JsonState(self.keys.path)
+
+    def load_dims(self):
+        # Players and names already exported keep their keys
+        for t, key, value in (("players", "player_key", "puuid"),
+                              ("names", "name_key", "name")):
+            df = read_table(self.path(t), self.format,
+                            keep_default_na=False)
+            self.dims[t] = dict(zip(df[value], df[key])) \
+                if df is not None else {}
+
+    def encode(self, values: pd.Series, dim: str,
+               added: List[str]) -> pd.Series:
+        keys = self.dims[dim]
+        for value in values.dropna().unique():
+            if value not in keys:
+                keys[value] = len(keys)
+                added.append(value)
+        return values.map(keys).astype('Int64')
+
+    def normalize(self, tables: Dict[str, pd.DataFrame]):
+        # Shifts a chunk's keys past the ones already exported and swaps
+        # strings for keys, returning new players and names first
+        for t, key in STAR_KEYS.items():
+            offset = self.keys.get(t, 0)
+            for df in tables.values():
+                if key in df:
+                    df[key] += offset
+            self.keys.set(t, offset + len(tables[t]))
+
+        players, names = [], []
+        if 'puuid' in tables["participants"]:
+            tables["participants"]['player_key'] = self.encode(
+                tables["participants"].pop('puuid'), "players", players)
+        for df in tables.values():
+            for column, key in STAR_NAMES.items():
+                if column in df:
+                    df[key] = self.encode(df.pop(column), "names", names)
+
+        return {
+            "players": pd.DataFrame({
+                'player_key': [self.dims["players"][p] for p in players],
+                'puuid': players,
+            }),
+            "names": pd.DataFrame({
+                'name_key': [self.dims["names"][n] for n in names],
+                'name': names,
+            }),
+        } | tables
+
+    def flatten(self, chunks: Iterable[List[Tuple[str, bytes]]]):
+        # Yields the keys and columns of each chunk in order. Only a couple
+        # of chunks per process are read ahead, so memory stays flat.
+        processes = self.processes or os.cpu_count()
+        flatten = partial(flatten_chunk, self.layout)
+        if processes == 1:
+            init_worker(self.cache.codec.dict_dir)
+            for chunk in chunks:
+                yield [key for key, _ in chunk], flatten(chunk)
+            return
+        with ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_worker,
+                initargs=(self.cache.codec.dict_dir,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(([key for key, _ in chunk],
+                                pool.submit(flatten, chunk)))
+                if len(pending) >= processes * 2:
+                    keys, future = pending.popleft()
+                    yield keys, future.result()
+            while pending:
+                keys, future = pending.popleft()
+                yield keys, future.result()
+
+    def stale_manifest(self) -> bool:
+        # Manifests used to hold file paths, which matched no cache key
+        # after cache_dir was spelled differently
+        return any("/" in key for key in self.manifest.load())
 
-    def export_all(self):
-        files = glob.glob(f"{self.cache_dir}/match-*.json")
-
-        all_data = []
-        m_data = []
-        p_data = []
-        a_data = []
-        t_data = []
-        u_data = []
-        i_data = []
-
-        info(f"Exporting {len(files)} match files")
-        for fname in tqdm(files):
-            with open(fname, 'r') as f:
-                m = json.loads(f.read())
-                all_data.append((fname, m))
-
-        info(f"Exporting {len(all_data)} match results")
-        for (fname ,m) in tqdm(all_data):
-            try:
-                match = {
-                    'match_id': m['metadata']['match_id'],
-                    'match_datetime': m['info']['game_datetime'],
-                    'match_length': m['info']['game_length'],
-                    'tft_set_number': m['info']['tft_set_number'],
-                    'tft_set_name': m['info']['tft_set_core_name'],
-                }
-                m_data.append(match)
-
-                for p in m['info']['participants']:
-                    participant = select_keys(p, [
-                        'puuid',
-                        'placement',
-                    ])
-                    participant_data = select_keys(p, [
-                        'level',
-                        'total_damage_to_players',
-                        'last_round',
-                    ])
-                    p_data.append(participant_data | participant | match)
-
-                    for a in p['augments']:
-                        a_data.append({'augment': a} | participant | match)
-
-                    for t in p['traits']:
-                        trait = select_keys(t, [
-                            'name',
-                            'num_units',
-                            'style',
-                            'tier_current',
-                            'tier_total',
-                        ], {'name': 'trait'})
-                        t_data.append(trait | participant | match)
-
-                    for u in p['units']:
-                        unit = select_keys(u, [
-                            'character_id',
-                        ])
-                        unit_data = select_keys(u, [
-                            'name',
-                            'rarity',
-                            'tier',
-                        ], {'name': 'character_name'})
-                        u_data.append(unit | unit_data | participant | match)
-
-                        for i in u['itemNames']:
-                            i_data.append({'item': i} | unit | participant | match)
-            except Exception as e:
-                error(f"Colud not process {fname}")
-                error(e)
-
-        matches_df = pd.DataFrame(m_data)
-        participants_df = pd.DataFrame(p_data)
-        aug_df = pd.DataFrame(a_data)
-        trait_df = pd.DataFrame(t_data)
-        unit_df = pd.DataFrame(u_data)
-        item_df = pd.DataFrame(i_data)
-
-        print(matches_df)
-        print(participants_df)
-        print(aug_df)
-        print(trait_df)
-        print(unit_df)
-        print(item_df)
-
-        self.to_file(matches_df, "matches")
-        self.to_file(participants_df, "participants")
-        self.to_file(aug_df, "augments")
-        self.to_file(trait_df, "traits")
-        self.to_file(unit_df, "units")
-        self.to_file(item_df, "items")
+    def export_all(self, full: bool = False):
+        # Only matches missing from the manifest are exported and appended
+        # to the files. A full export rebuilds them, e.g. after the columns
+        # changed, and whenever files from before the manifest are around.
+        self.rollback()
+        if full or not os.path.exists(self.manifest.path) or \
+                self.stale_manifest():
+            self.reset()
+        exported = self.manifest.load()
+        if self.layout == "star":
+            self.load_dims()
+
+        total = self.cache.count("match")
+        info(f"Exporting {total - len(exported)} of {total} match entries")
+        chunks = chunked(self.cache.raw_items("match", skip=exported),
+                         self.chunk_size)
+        rows = dict.fromkeys(self.tables, 0)
+        buffered = {t: [] for t in self.tables}
+        keys = []
+        with tqdm(total=total - len(exported)) as progress:
+            for chunk_keys, chunk in self.flatten(chunks):
+                tables = {t: pd.DataFrame(c) for t, c in chunk.items()}
+                if self.layout == "star":
+                    tables = self.normalize(tables)
+                for t, df in tables.items():
+                    buffered[t].append(df)
+                keys += chunk_keys
+                if len(keys) >= self.flush_size:
+                    self.flush(buffered, keys, rows)
+                    buffered = {t: [] for t in self.tables}
+                    keys = []
+                progress.update(len(chunk_keys))
+            self.flush(buffered, keys, rows)
+
+        if self.format == "parquet":
+            for t in self.tables:
+                self.compact(t)
+        info("Exported " + ", ".join(f"{rows[t]} {t}" for t in self.tables))
+
+    def flush(self, buffered: Dict[str, List[pd.DataFrame]],
+              keys: List[str], rows: Dict[str, int]):
+        # Matches are recorded once written, so an interrupted export
+        # carries on where it stopped. Unreadable matches are recorded too,
+        # they would fail again. A journal of the sizes files had before
+        # the write lets the next export undo a write that was cut short,
+        # rather than write its matches twice.
+        if not keys:
+            return
+        batch = uuid.uuid4().hex
+        self.write_journal(batch)
+        for t, dfs in buffered.items():
+            df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+            rows[t] += len(df)
+            if self.format == "parquet":
+                self.to_parquet(df, t, batch)
+            else:
+                self.to_file(df, t)
+        # Key counters go first, counters behind the files would hand out
+        # their keys again
+        self.keys.save()
+        self.manifest.update(keys)
+        os.remove(self.journal)
+
+    def write_journal(self, batch: str):
+        # Parquet writes new files named after the batch, CSV appends
+        paths = [self.manifest.path]
+        if self.format == "csv":
+            paths += [self.path(t) for t in self.tables]
+        sizes = {os.path.basename(path): os.path.getsize(path)
+                 if os.path.exists(path) else None for path in paths}
+        with open(f"{self.journal}.tmp", 'w') as f:
+            json.dump({"batch": batch, "sizes": sizes}, f)
+        os.replace(f"{self.journal}.tmp", self.journal)
+
+    def rollback(self):
+        if not os.path.exists(self.journal):
+            return
+        info(f"Rolling back an interrupted export from {self.journal}")
+        with open(self.journal, 'r') as f:
+            journal = json.load(f)
+        for name, size in journal["sizes"].items():
+            path = f"{self.root}/{name}"
+            if size is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            elif os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        if self.format == "parquet":
+            for t in self.tables:
+                for root, _, files in os.walk(self.path(t)):
+                    for f in files:
+                        if f.startswith(journal["batch"]):
+                            os.remove(f"{root}/{f}")
+        os.remove(self.journal)
+        # Drop what this process may still hold of the undone write
+        self.manifest = MatchIndex(self.manifest.path)
+        self.keys = JsonState(self.keys.path)
+
+    def compact(self, fname: str):
+        # Merges small files, so readers do not open one per export. The
+        # merged file is journaled before the small ones go, a crash
+        # neither loses nor doubles rows.
+        pa, pq = arrow()
+        if not os.path.isdir(self.path(fname)):
+            return
+        for root, _, _ in list(os.walk(self.path(fname))):
+            self.finish_compaction(root)
+            small = sorted(
+                f for f in os.listdir(root)
+                if f.endswith(".parquet") and not f.startswith(".") and
+                os.path.getsize(f"{root}/{f}") < COMPACT_BYTES)
+            if len(small) <= COMPACT_FILES:
+                continue
+            info(f"Merging {len(small)} files in {root}")
+            name = uuid.uuid4().hex
+            table = pa.concat_tables(
+                [pq.read_table(f"{root}/{f}") for f in small])
+            pq.write_table(table, f"{root}/.{name}.tmp", compression="zstd")
+            with open(f"{root}/.{name}.json.tmp", 'w') as f:
+                json.dump(small, f)
+            os.replace(f"{root}/.{name}.json.tmp", f"{root}/.{name}.json")
+            self.finish_compaction(root)
+
+    def finish_compaction(self, root: str):
+        # A journal lists the files its merged file replaces. Merges that
+        # never got their journal are dropped.
+        for journal in os.listdir(root):
+            if not (journal.startswith(".") and journal.endswith(".json")):
+                continue
+            name = journal[1:-len(".json")]
+            with open(f"{root}/{journal}", 'r') as f:
+                for merged in json.load(f):
+                    if os.path.exists(f"{root}/{merged}"):
+                        os.remove(f"{root}/{merged}")
+            if os.path.exists(f"{root}/.{name}.tmp"):
+                os.replace(f"{root}/.{name}.tmp", f"{root}/{name}-0.parquet")
+            os.remove(f"{root}/{journal}")
+        for f in os.listdir(root):
+            if f.startswith(".") and f.endswith(".tmp"):
+                os.remove(f"{root}/{f}")
+
+    def path(self, fname: str) -> str:
+        if self.format == "parquet":
+            return f"{self.root}/{fname}"
+        return f"{self.root}/{fname}.csv"
+
+    def to_parquet(self, df: pd.DataFrame, fname: str, batch: str):
+        # Star tables mostly lack the partition columns and are small
+        # enough to go without
+        if df.empty:
+            return
+        pa, pq = arrow()
+        partitions = None
+        if 'match_datetime' in df:
+            df = df.assign(match_datetime=pd.to_datetime(
+                df['match_datetime'], unit='ms'))
+        if self.layout == "flat":
+            df['match_date'] = df['match_datetime'].dt.strftime('%Y-%m-%d')
+            partitions = PARTITIONS
+        schema = pa.schema([
+            (c, pa.type_for_alias(COLUMN_TYPES.get(c, 'string')))
+            for c in df.columns])
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        pq.write_to_dataset(
+            table, self.path(fname),
+            partition_cols=partitions,
+            basename_template=f"{batch}-{{i}}.parquet",
+            compression="zstd",
+        )
 
     def to_file(self, df: pd.DataFrame, fname: str):
-        path = f"{self.data_dir}/{fname}.csv"
-        info(f"Writing {path}")
-        df.to_csv(path, index=False)
+        path = self.path(fname)
+        if df.empty:
+            return
+        if os.path.exists(path):
+            columns = pd.read_csv(path, nrows=0).columns
+            df.reindex(columns=columns).to_csv(path, mode='a', header=False,
+                                               index=False)
+        else:
+            info(f"Writing {path}")
+            df.to_csv(path, index=False)
 
 
 @dataclass
@@ -127,6 +606,71 @@ class Data:
 @dataclass
 class DataLoader:
     data_dir: str
+    format: str = "csv"
+    layout: str = "flat"
+
+    def read(self, f: str) -> pd.DataFrame:
+        root = f"{self.data_dir}/star"
+        # Names and players include the empty string
+        keep_default_na = f not in ("players", "names")
+        if self.format == "parquet":
+            return read_table(f"{root}/{f}", self.format)
+        return read_table(f"{root}/{f}.csv", self.format, keep_default_na)
+
+    def read_star(self, f: str, since: np.datetime64,
+                  set_name: Optional[str],
+                  star: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+        # Joins a star layout table back into its flat shape. Matches,
+        # players, names and participants are read once into star.
+        if not star:
+            matches = self.read("matches")
+            if self.format == "csv":
+                matches['match_datetime'] = pd.to_datetime(
+                    matches['match_datetime'], unit='ms', origin='unix')
+            matches = matches[matches['match_datetime'] >= since]
+            if set_name:
+                matches = matches[matches['tft_set_name'] == set_name]
+            star["names"] = self.read("names").set_index('name_key')['name']
+            star["participants"] = self.read("participants") \
+                .merge(matches, on='match_key') \
+                .merge(self.read("players"), on='player_key')
+
+        participants = star["participants"]
+        if f == "participants":
+            df = participants
+        else:
+            df = self.read(f)
+            if f == "items":
+                units = self.read("units")
+                df = df.merge(units[['unit_key', 'participant_key',
+                                     'character_key']], on='unit_key')
+            df = df.merge(participants[[
+                'participant_key',
+                'puuid',
+                'placement',
+                'match_id',
+                'match_datetime',
+                'match_length',
+                'tft_set_number',
+                'tft_set_name',
+            ]], on='participant_key')
+
+        for column, key in STAR_NAMES.items():
+            if key in df:
+                df[column] = df.pop(key).map(star["names"])
+        df = df.drop(columns=[c for c in df.columns if c.endswith('_key')])
+        return df.set_index(['match_id', 'puuid'])
+
+    def read_parquet(self, f: str, since: np.datetime64,
+                     set_name: Optional[str]) -> pd.DataFrame:
+        # Partitions rule out whole days and sets before anything is read
+        _, pq = arrow()
+        filters = [('match_date', '>=', str(since.astype('datetime64[D]')))]
+        if set_name:
+            filters.append(('tft_set_name', '=', set_name))
+        df = pq.read_table(f"{self.data_dir}/{f}", filters=filters,
+                           partitioning="hive").to_pandas()
+        return df.drop(columns='match_date').set_index(['match_id', 'puuid'])
 
     def load_all(self, files: List[str] = [], days_cutoff: int = 7, set_name: Optional[str] = None):
         files = files or [
@@ -137,16 +681,23 @@ class DataLoader:
             "items",
         ]
 
+        since = np.datetime64('now') - np.timedelta64(days_cutoff, 'D')
+
         data = {}
+        star = {}
         for f in tqdm(files):
-            path = f"{self.data_dir}/{f}.csv"
-            df = pd.read_csv(path, index_col=['match_id', 'puuid'])
+            if self.layout == "star":
+                df = self.read_star(f, since, set_name, star)
+            elif self.format == "parquet":
+                df = self.read_parquet(f, since, set_name)
+            else:
+                path = f"{self.data_dir}/{f}.csv"
+                df = pd.read_csv(path, index_col=['match_id', 'puuid'])
 
-            # parse date time
-            df['match_datetime'] = pd.to_datetime(df['match_datetime'], unit='ms', origin='unix')
+                # parse date time
+                df['match_datetime'] = pd.to_datetime(df['match_datetime'], unit='ms', origin='unix')
 
             # filter matches since n days
-            since = np.datetime64('now') - np.timedelta64(days_cutoff, 'D')
             df = df[df['match_datetime'] >= since]
 
             # filter by set
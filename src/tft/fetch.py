@@ -0,0 +1,236 @@
+from dataclasses import dataclass, field
+from logging import warning
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Dict, Optional
+import random
+import requests
+import threading
+import time
+
+from tft.metrics import Metrics
+from tft.ratelimit import KeyPool
+
+
+class FetchError(Exception):
+    # retry_after is set when the request was refused for lack of capacity
+    # rather than tried, and says when trying again is worthwhile
+    def __init__(self, url: str, reason: str,
+                 retry_after: Optional[float] = None):
+        super().__init__(f"{url}: {reason}")
+        self.url = url
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class CircuitBreaker:
+    # Opens after `threshold` failures in a row, then lets a single probe
+    # through every `cooldown` seconds until one succeeds
+    threshold: int = 5
+    cooldown: float = 30
+    failures: int = 0
+    opened_at: Optional[float] = None
+    probing: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or \
+                    time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def retry_in(self) -> float:
+        # A probe in flight may take until the next cooldown to open the
+        # circuit again
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            if self.probing:
+                return self.cooldown
+            return max(0.0, self.opened_at + self.cooldown -
+                       time.monotonic())
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+@dataclass
+class Fetcher:
+    keys: KeyPool
+    pool_size: int = 10
+    timeout: float = 10
+    retries: int = 5
+    backoff: float = 0.5
+    max_backoff: float = 30
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 30
+    # How long a 404 is remembered, so dead ids are not hammered
+    not_found_ttl: float = 10 * 60
+    # Called with routing, endpoint, status (None when the request failed)
+    # and seconds taken for every request sent
+    observe: Optional[Callable[[str, str, Optional[int], float], None]] = None
+    metrics: Metrics = field(default_factory=Metrics)
+    # Set to give up on requests waiting for a token or a retry
+    stop: threading.Event = field(default_factory=threading.Event)
+    sessions: Dict[str, requests.Session] = field(default_factory=dict,
+                                                  init=False, repr=False)
+    breakers: Dict[str, CircuitBreaker] = field(default_factory=dict,
+                                                init=False, repr=False)
+    not_found: Dict[str, float] = field(default_factory=dict,
+                                        init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def session(self, routing: str) -> requests.Session:
+        with self._lock:
+            if routing not in self.sessions:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[routing] = session
+            return self.sessions[routing]
+
+    def breaker(self, routing: str) -> CircuitBreaker:
+        with self._lock:
+            if routing not in self.breakers:
+                self.breakers[routing] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_cooldown)
+            return self.breakers[routing]
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+    def known_missing(self, url: str) -> bool:
+        with self._lock:
+            expires = self.not_found.get(url)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.not_found[url]
+                return False
+            return True
+
+    def sleep_backoff(self, attempt: int) -> float:
+        # Full jitter keeps retrying workers from moving in lockstep
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        self.stop.wait(delay)
+        return delay
+
+    def get(
+        self,
+        routing: str,
+        url: str,
+        endpoint: str,
+        region: Optional[str] = None,
+    ) -> Optional[Any]:
+        # Returns the decoded body, None for a 404, raises FetchError when
+        # the request cannot succeed or retries run out
+        labels = {"region": region or routing, "endpoint": endpoint}
+        if self.known_missing(url):
+            self.metrics.inc("tft_known_missing_total", **labels)
+            return None
+
+        session = self.session(routing)
+        breaker = self.breaker(routing)
+        attempt = 0
+        while True:
+            if self.stop.is_set():
+                # Abandoned, the job is taken again in the next run
+                raise FetchError(url, "stopping", retry_after=0)
+            if not breaker.allow():
+                raise FetchError(url, f"circuit open for {routing}",
+                                 retry_after=breaker.retry_in())
+
+            waited = time.monotonic()
+            token = self.keys.acquire(routing, endpoint, self.stop)
+            if token is None:
+                raise FetchError(url, "stopping", retry_after=0)
+            started = time.monotonic()
+            self.metrics.inc("tft_throttle_seconds_total", started - waited,
+                             **labels)
+            try:
+                resp = session.get(url, headers={"X-Riot-Token": token},
+                                   timeout=self.timeout)
+            except requests.RequestException as e:
+                status, reason = None, str(e)
+            else:
+                status, reason = resp.status_code, f"HTTP {resp.status_code}"
+                retired = self.keys.update(token, routing, endpoint, status,
+                                           resp.headers, url)
+            seconds = time.monotonic() - started
+            self.metrics.inc("tft_requests_total",
+                             status=str(status or "error"), **labels)
+            self.metrics.observe("tft_request_seconds", seconds, **labels)
+            if status is not None:
+                self.metrics.inc("tft_response_bytes_total",
+                                 len(resp.content), **labels)
+            if self.observe:
+                self.observe(routing, endpoint, status, seconds)
+
+            if status == 200:
+                breaker.success()
+                try:
+                    return resp.json()
+                except ValueError:
+                    raise FetchError(url, "invalid JSON body")
+
+            if status == 404:
+                breaker.success()
+                with self._lock:
+                    self.not_found[url] = \
+                        time.monotonic() + self.not_found_ttl
+                return None
+
+            if status in (401, 403):
+                # Only worth another key when this one was retired, a 403
+                # for the url itself would fail on every key
+                breaker.success()
+                if retired:
+                    continue
+                raise FetchError(url, reason)
+
+            if status == 429:
+                # The key pool waits out Retry-After. Our own limits clear
+                # by then, but Riot's services may keep refusing, so those
+                # count as retries.
+                breaker.success()
+                limit_type = resp.headers.get("X-Rate-Limit-Type", "service")
+                if limit_type == "service":
+                    if attempt >= self.retries:
+                        raise FetchError(
+                            url, f"{reason} after {attempt} retries",
+                            float(resp.headers.get("Retry-After", 1)))
+                    attempt += 1
+                continue
+
+            if status is not None and status < 500:
+                breaker.success()
+                raise FetchError(url, reason)
+
+            breaker.failure()
+            if attempt >= self.retries:
+                raise FetchError(url, f"{reason} after {attempt} retries")
+            warning(f"{url}: {reason}, retry {attempt + 1}/{self.retries}")
+            self.metrics.inc("tft_backoff_seconds_total",
+                             self.sleep_backoff(attempt), **labels)
+            attempt += 1
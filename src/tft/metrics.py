@@ -0,0 +1,127 @@
+from dataclasses import dataclass, field
+from logging import info
+from typing import Dict, List, Tuple
+import json
+import os
+import threading
+
+# Request latencies in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    bounds: List[float]
+    counts: List[int] = field(default_factory=list)
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        # The last count is for values above every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float):
+        i = next((i for i, b in enumerate(self.bounds) if value <= b),
+                 len(self.bounds))
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the quantile
+        seen = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class Metrics:
+    # Counters and histograms by name and labels, e.g. region and endpoint
+    counters: Dict[str, Dict[Labels, float]] = field(default_factory=dict)
+    histograms: Dict[str, Dict[Labels, Histogram]] = field(
+        default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(BUCKETS)
+            series[key].observe(value)
+
+    def total(self, name: str) -> float:
+        with self._lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value}
+                           for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key),
+                            "count": h.count,
+                            "sum": h.sum,
+                            "p50": h.quantile(0.5),
+                            "p99": h.quantile(0.99),
+                            "buckets": dict(zip(
+                                map(str, h.bounds + ["+Inf"]), h.counts))}
+                           for key, h in series.items()]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def prometheus(self) -> str:
+        def labels(key, **extra):
+            pairs = list(key) + list(extra.items())
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines += [f"{name}{labels(key)} {value}"
+                          for key, value in sorted(series.items())]
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, h in sorted(series.items()):
+                    seen = 0
+                    for bound, count in zip(h.bounds + ["+Inf"], h.counts):
+                        seen += count
+                        lines.append(f"{name}_bucket"
+                                     f"{labels(key, le=bound)} {seen}")
+                    lines.append(f"{name}_sum{labels(key)} {h.sum}")
+                    lines.append(f"{name}_count{labels(key)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # A .prom file for node_exporter's textfile collector, JSON
+        # otherwise. Written atomically, the collector may read any time.
+        path = path.format(pid=os.getpid())
+        if path.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        info(f"Wrote metrics to {path}")
@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import info
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from tft.ratelimit import Limits
+
+ROUTES = [
+    ("league", re.compile(r"/tft/league/v1/(?P<league>[^/]+)$")),
+    ("summoner", re.compile(
+        r"/tft/summoner/v1/summoners/summoner-(?P<n>\d+)$")),
+    ("match-ids", re.compile(
+        r"/tft/match/v1/matches/by-puuid/puuid-(?P<n>\d+)/ids$")),
+    ("match", re.compile(r"/tft/match/v1/matches/[A-Z0-9]+_(?P<n>\d+)$")),
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+
+@dataclass
+class MockRiotApi:
+    # A local stand-in for the Riot API serving synthetic players and
+    # matches, so the scraper can be load tested without spending a key
+    platform: str = "NA1"
+    host: str = "127.0.0.1"
+    port: int = 0
+    # Seconds each response takes, give or take latency_jitter
+    latency: float = 0.05
+    latency_jitter: float = 0.02
+    # Enforced per API key and routing value, like Riot does
+    app_limits: str = "20:1,100:120"
+    # Share of requests answered with a 503 or a service 429 regardless
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    players: int = 200
+    matches_per_player: int = 20
+    seed: int = 0
+    started_at: int = field(default_factory=lambda: int(time.time()))
+    requests: int = field(default=0, init=False)
+    server: Optional[ThreadingHTTPServer] = field(default=None, init=False,
+                                                  repr=False)
+    limits: Dict[Tuple[str, str], Limits] = field(default_factory=dict,
+                                                  init=False, repr=False)
+    _random: random.Random = field(init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+
+    @property
+    def url(self) -> str:
+        # An api_url template for the Scraper
+        return f"http://{self.host}:{self.server.server_port}/{{routing}}"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes, which Nagle's
+            # algorithm would hold back for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, headers, body = api.respond(
+                    self.path, self.headers.get("X-Riot-Token", ""))
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        info(f"Mock Riot API listening on {self.url}")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def respond(self, url: str, token: str) -> Tuple[int, Dict[str, str], Any]:
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._random.uniform(
+                -self.latency_jitter, self.latency_jitter))
+            roll = self._random.random()
+        time.sleep(delay)
+
+        parsed = urlparse(url)
+        routing, _, path = parsed.path.lstrip("/").partition("/")
+        headers, wait = self.spend(token, routing)
+        if wait > 0:
+            return 429, headers | {
+                "Retry-After": str(math.ceil(wait)),
+                "X-Rate-Limit-Type": "application",
+            }, {"status": {"status_code": 429}}
+        if roll < self.error_rate:
+            return 503, headers, {"status": {"status_code": 503}}
+        if roll < self.error_rate + self.throttle_rate:
+            return 429, headers | {
+                "Retry-After": "1",
+                "X-Rate-Limit-Type": "service",
+            }, {"status": {"status_code": 429}}
+
+        query = {k: int(v[0]) for k, v in parse_qs(parsed.query).items()}
+        for endpoint, pattern in ROUTES:
+            match = pattern.match(f"/{path}")
+            if match:
+                body = getattr(self, endpoint.replace("-", "_"))(
+                    **match.groupdict(), **query)
+                if body is not None:
+                    return 200, headers, body
+        return 404, headers, {"status": {"status_code": 404}}
+
+    def spend(self, token: str, routing: str) -> Tuple[Dict[str, str], float]:
+        with self._lock:
+            now = time.monotonic()
+            key = (token, routing)
+            if key not in self.limits:
+                # Exact windows like Riot's, the client keeps the slack
+                self.limits[key] = Limits(slack=0)
+                self.limits[key].configure(self.app_limits)
+            limits = self.limits[key]
+            wait = limits.wait_time(now)
+            if wait <= 0:
+                limits.take(now)
+            counts = ",".join(f"{len(b.spent)}:{b.window}"
+                              for b in limits.buckets)
+        return {
+            "X-App-Rate-Limit": self.app_limits,
+            "X-App-Rate-Limit-Count": counts,
+        }, wait
+
+    def game_time(self, n: int) -> int:
+        # A player's matches are half an hour apart, newest first
+        return self.started_at - (n % self.matches_per_player) * 30 * 60
+
+    def league(self, league: str):
+        return {
+            "tier": league.upper(),
+            "entries": [{
+                "summonerId": f"summoner-{n}",
+                "wins": 50 + n % 13,
+                "losses": 50 + n % 7,
+            } for n in range(self.players)],
+        }
+
+    def summoner(self, n: str):
+        if int(n) >= self.players:
+            return None
+        return {
+            "id": f"summoner-{n}",
+            "puuid": f"puuid-{n}",
+            "name": f"Player {n}",
+            "summonerLevel": 100 + int(n),
+        }
+
+    def match_ids(self, n: str, start: int = 0, count: int = 20,
+                  startTime: int = 0):
+        if int(n) >= self.players:
+            return None
+        first = int(n) * self.matches_per_player
+        ids = [f"{self.platform}_{m}"
+               for m in range(first, first + self.matches_per_player)
+               if self.game_time(m) >= startTime]
+        return ids[start:start + count]
+
+    def match(self, n: str):
+        n = int(n)
+        owner = n // self.matches_per_player
+        if owner >= self.players:
+            return None
+        rng = random.Random(n)
+        others = rng.sample([p for p in range(self.players) if p != owner],
+                            min(7, self.players - 1))
+        puuids = [f"puuid-{p}" for p in [owner] + others]
+        placements = list(range(1, len(puuids) + 1))
+        rng.shuffle(placements)
+        return {
+            "metadata": {
+                "data_version": "5",
+                "match_id": f"{self.platform}_{n}",
+                "participants": puuids,
+            },
+            "info": {
+                "game_datetime": self.game_time(n) * 1000,
+                "game_length": rng.uniform(1500, 2400),
+                "tft_set_number": 9,
+                "tft_set_core_name": "TFTSet9",
+                "participants": [
+                    self.participant(rng, puuid, placement)
+                    for puuid, placement in zip(puuids, placements)
+                ],
+            },
+        }
+
+    def participant(self, rng: random.Random, puuid: str, placement: int):
+        return {
+            "puuid": puuid,
+            "placement": placement,
+            "level": rng.randint(6, 10),
+            "total_damage_to_players": rng.randint(0, 200),
+            "last_round": rng.randint(20, 40),
+            "augments": [f"TFT9_Augment_{rng.randint(1, 200)}"
+                         for _ in range(3)],
+            "traits": [{
+                "name": f"Set9_Trait{rng.randint(1, 30)}",
+                "num_units": rng.randint(1, 6),
+                "style": rng.randint(0, 4),
+                "tier_current": rng.randint(0, 3),
+                "tier_total": 3,
+            } for _ in range(rng.randint(4, 9))],
+            "units": [{
+                "character_id": f"TFT9_Champion{rng.randint(1, 60)}",
+                "name": "",
+                "rarity": rng.randint(0, 6),
+                "tier": rng.randint(1, 3),
+                "itemNames": [f"TFT_Item_{rng.randint(1, 50)}"
+                              for _ in range(rng.randint(0, 3))],
+            } for _ in range(rng.randint(6, 10))],
+        }
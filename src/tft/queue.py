@@ -0,0 +1,270 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import info
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: int
+    region: str
+    kind: str
+    key: str
+    payload: Any
+    attempts: int
+    deferrals: int = 0
+
+
+@dataclass
+class PriorityPolicy:
+    # Jobs with a higher priority are taken first
+    tiers: Dict[str, float] = field(default_factory=lambda: {
+        "challenger": 3,
+        "grandmaster": 2,
+        "master": 1,
+    })
+    # Per game a player played since their matches were last listed
+    unseen_games: float = 0.1
+    # Bonus for the newest match of a listing, shrinking with its position
+    recency: float = 1.0
+    # Bonus for matches over players, so listed matches are fetched first
+    match: float = 1.0
+    # Taken off per hop a discovered player or match is from the ladder
+    depth: float = 1.0
+
+    def for_summoner(self, league: str, unseen: int) -> float:
+        return self.tiers.get(league, 0) + self.unseen_games * unseen
+
+    def for_player(self, depth: int) -> float:
+        return -self.depth * depth
+
+    def for_match(self, league: Optional[str], position: int,
+                  depth: int = 0) -> float:
+        return (self.tiers.get(league, 0) + self.match +
+                self.recency / (1 + position) - self.depth * depth)
+
+
+@dataclass
+class WorkQueue:
+    # Several worker processes can share the queue file, each job taken is
+    # leased to its worker and goes back to the queue if the lease runs out
+    path: str
+    max_attempts: int = 3
+    # Seconds a failed job waits before its next attempt, doubling with
+    # every attempt spent
+    backoff: float = 30
+    # Times a job may wait out a retry_after before it spends attempts
+    # again, so a host that stays down does not keep jobs around forever
+    max_deferrals: int = 20
+    worker: str = field(
+        default_factory=lambda: f"{socket.gethostname()}:{os.getpid()}")
+    conn: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        self.conn = sqlite3.connect(self.path, timeout=60,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                region TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                priority REAL NOT NULL DEFAULT 0,
+                not_before REAL,
+                deferrals INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (region, kind, key)
+            );
+        """)
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(jobs)")]
+        for column in ("lease_until REAL", "worker TEXT",
+                       "priority REAL NOT NULL DEFAULT 0",
+                       "not_before REAL",
+                       "deferrals INTEGER NOT NULL DEFAULT 0"):
+            if column.split()[0] not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        self.conn.executescript("""
+            CREATE INDEX IF NOT EXISTS jobs_state
+                ON jobs (region, kind, state);
+            CREATE INDEX IF NOT EXISTS jobs_priority
+                ON jobs (state, priority DESC, id);
+        """)
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so two processes can not
+        # both read a job as pending and take it
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def push(self, region: str, kind: str,
+             items: Iterable[Tuple[str, Any, float]], refresh: bool = True):
+        # New and failed keys are queued. With refresh, finished keys are
+        # queued again when their payload changed, e.g. a player's game
+        # count. Keys still pending keep the highest priority they were
+        # given.
+        rows = [(region, kind, key, json.dumps(payload), PENDING,
+                 time.time(), priority)
+                for key, payload, priority in items]
+        reset = ("(state = 'failed' OR "
+                 f"({int(refresh)} AND state = 'done' AND "
+                 "payload IS NOT excluded.payload))")
+        with self.transaction() as conn:
+            conn.executemany(f"""
+                INSERT INTO jobs (region, kind, key, payload, state,
+                                  updated_at, priority)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (region, kind, key) DO UPDATE SET
+                    payload = CASE WHEN {int(refresh)} OR {reset}
+                        THEN excluded.payload ELSE payload END,
+                    priority = CASE
+                        WHEN state = 'pending'
+                            THEN max(priority, excluded.priority)
+                        WHEN {reset} THEN excluded.priority
+                        ELSE priority END,
+                    attempts = CASE WHEN {reset} THEN 0 ELSE attempts END,
+                    not_before = CASE WHEN {reset} THEN NULL
+                        ELSE not_before END,
+                    deferrals = CASE WHEN {reset} THEN 0 ELSE deferrals END,
+                    updated_at = excluded.updated_at,
+                    state = CASE WHEN {reset} THEN 'pending' ELSE state END
+                WHERE state != 'in-flight'
+            """, rows)
+
+    def take(
+        self,
+        n: int,
+        region: Optional[str] = None,
+        kind: Optional[str] = None,
+        lease: float = 600,
+    ) -> List[Job]:
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute("""
+                SELECT id, region, kind, key, payload, attempts, deferrals
+                FROM jobs
+                WHERE (? IS NULL OR region = ?) AND (? IS NULL OR kind = ?)
+                  AND ((state = ? AND coalesce(not_before, 0) <= ?)
+                       OR (state = ? AND lease_until < ?))
+                ORDER BY priority DESC, id LIMIT ?
+            """, (region, region, kind, kind, PENDING, now, IN_FLIGHT, now,
+                  n)).fetchall()
+            conn.executemany("""
+                UPDATE jobs SET state = ?, lease_until = ?, worker = ?,
+                                updated_at = ?
+                WHERE id = ?
+            """, [(IN_FLIGHT, now + lease, self.worker, now, row[0])
+                  for row in rows])
+        return [Job(id, region, kind, key, json.loads(payload), attempts,
+                    deferrals)
+                for (id, region, kind, key, payload, attempts, deferrals)
+                in rows]
+
+    def done(self, job: Job):
+        with self.transaction() as conn:
+            conn.execute("""
+                UPDATE jobs SET state = ?, lease_until = NULL, updated_at = ?
+                WHERE id = ?
+            """, (DONE, time.time(), job.id))
+
+    def fail(self, job: Job, retry_after: Optional[float] = None):
+        # Failed jobs go back to pending until they run out of attempts,
+        # backing off longer each time. A retry_after means the job could
+        # not be tried, e.g. while a circuit is open, so it waits that long
+        # without spending an attempt, up to max_deferrals times.
+        now = time.time()
+        deferrals = job.deferrals
+        if retry_after is not None and deferrals < self.max_deferrals:
+            state, attempts, not_before = PENDING, job.attempts, \
+                now + retry_after
+            deferrals += 1
+        else:
+            attempts = job.attempts + 1
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            not_before = now + max(retry_after or 0,
+                                   self.backoff * 2 ** (attempts - 1))
+        with self.transaction() as conn:
+            conn.execute("""
+                UPDATE jobs SET state = ?, attempts = ?, deferrals = ?,
+                                not_before = ?, lease_until = NULL,
+                                updated_at = ?
+                WHERE id = ?
+            """, (state, attempts, deferrals, not_before, now, job.id))
+
+    def recover(self, region: Optional[str] = None):
+        # Only safe when no other worker is running, otherwise wait for
+        # leases to run out
+        with self.transaction() as conn:
+            recovered = conn.execute("""
+                UPDATE jobs SET state = ?, lease_until = NULL
+                WHERE state = ? AND (? IS NULL OR region = ?)
+            """, (PENDING, IN_FLIGHT, region, region)).rowcount
+        if recovered:
+            info(f"Recovered {recovered} unfinished jobs")
+
+    def retry_failed(self, region: Optional[str] = None):
+        # Failed jobs get a fresh set of attempts. Nothing else queues
+        # failed matches again, their players' watermarks moved past them.
+        with self.transaction() as conn:
+            retried = conn.execute("""
+                UPDATE jobs SET state = ?, attempts = 0, deferrals = 0,
+                                not_before = NULL, updated_at = ?
+                WHERE state = ? AND (? IS NULL OR region = ?)
+            """, (PENDING, time.time(), FAILED, region, region)).rowcount
+        if retried:
+            info(f"Retrying {retried} failed jobs")
+
+    def next_due(self, region: Optional[str] = None) -> Optional[float]:
+        # Seconds until a pending job can be taken, None when there is none
+        with self._lock:
+            due = self.conn.execute("""
+                SELECT MIN(coalesce(not_before, 0)) FROM jobs
+                WHERE state = ? AND (? IS NULL OR region = ?)
+            """, (PENDING, region, region)).fetchone()[0]
+        return None if due is None else max(0.0, due - time.time())
+
+    def pending(self, region: Optional[str] = None) -> int:
+        with self._lock:
+            return self.conn.execute("""
+                SELECT COUNT(*) FROM jobs
+                WHERE state IN (?, ?) AND (? IS NULL OR region = ?)
+            """, (PENDING, IN_FLIGHT, region, region)).fetchone()[0]
+
+    def stats(self) -> List[Tuple[str, str, str, int]]:
+        with self._lock:
+            return self.conn.execute("""
+                SELECT region, kind, state, COUNT(*) FROM jobs
+                GROUP BY region, kind, state ORDER BY region, kind, state
+            """).fetchall()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,352 @@
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import warning
+from typing import Any, Deque, Dict, List, Mapping, Optional, Set, Tuple
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Requests are counted on send but by Riot on receipt, keep a little slack
+SLACK = 0.05
+
+
+def parse_limits(header: Optional[str]) -> List[Tuple[int, int]]:
+    # "20:1,100:120" -> [(20, 1), (100, 120)]
+    if not header:
+        return []
+    return [(int(n), int(w))
+            for n, w in (part.split(":") for part in header.split(","))]
+
+
+@dataclass
+class Bucket:
+    limit: int
+    window: int
+    # Each spent token comes back one window after it was spent
+    spent: Deque[float] = field(default_factory=deque)
+    slack: float = SLACK
+
+    def prune(self, now: float):
+        while self.spent and self.spent[0] + self.window + self.slack <= now:
+            self.spent.popleft()
+
+    def wait_time(self, now: float) -> float:
+        self.prune(now)
+        if len(self.spent) < self.limit:
+            return 0.0
+        return self.spent[0] + self.window + self.slack - now
+
+    def take(self, now: float):
+        self.spent.append(now)
+
+    def sync(self, count: int, now: float):
+        # Riot's count can be ahead of ours, e.g. after a restart
+        self.prune(now)
+        for _ in range(count - len(self.spent)):
+            self.spent.append(now)
+
+
+@dataclass
+class Limits:
+    buckets: List[Bucket] = field(default_factory=list)
+    blocked_until: float = 0.0
+    slack: float = SLACK
+
+    def configure(self, header: Optional[str]):
+        limits = parse_limits(header)
+        if limits and limits != [(b.limit, b.window) for b in self.buckets]:
+            self.buckets = [Bucket(limit=n, window=w, slack=self.slack)
+                            for n, w in limits]
+
+    def sync(self, header: Optional[str], now: float):
+        counts = dict((w, n) for n, w in parse_limits(header))
+        for b in self.buckets:
+            if b.window in counts:
+                b.sync(counts[b.window], now)
+
+    def wait_time(self, now: float) -> float:
+        return max([self.blocked_until - now] +
+                   [b.wait_time(now) for b in self.buckets])
+
+    def take(self, now: float):
+        for b in self.buckets:
+            b.take(now)
+
+
+@dataclass
+class RateLimiter:
+    # Application limits to assume until Riot tells us the real ones
+    app_limits: str = "20:1,100:120"
+    app: Dict[str, Limits] = field(default_factory=dict)
+    method: Dict[Tuple[str, str], Limits] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def limits_for(self, routing: str, method: str) -> List[Limits]:
+        if routing not in self.app:
+            self.app[routing] = Limits()
+            self.app[routing].configure(self.app_limits)
+        key = (routing, method)
+        if key not in self.method:
+            self.method[key] = Limits()
+        return [self.app[routing], self.method[key]]
+
+    def reserve(self, routing: str, method: str) -> float:
+        # Takes a token and returns 0, or returns how long to wait
+        with self._lock:
+            now = time.monotonic()
+            limits = self.limits_for(routing, method)
+            wait = max(lim.wait_time(now) for lim in limits)
+            if wait > 0:
+                return wait
+            for lim in limits:
+                lim.take(now)
+            return 0.0
+
+    def update(
+        self,
+        routing: str,
+        method: str,
+        status: int,
+        headers: Mapping[str, str],
+    ):
+        with self._lock:
+            now = time.monotonic()
+            app, meth = self.limits_for(routing, method)
+            app.configure(headers.get("X-App-Rate-Limit"))
+            app.sync(headers.get("X-App-Rate-Limit-Count"), now)
+            meth.configure(headers.get("X-Method-Rate-Limit"))
+            meth.sync(headers.get("X-Method-Rate-Limit-Count"), now)
+
+            if status == 429:
+                retry_after = float(headers.get("Retry-After", 1))
+                limit_type = headers.get("X-Rate-Limit-Type", "service")
+                warning(f"Rate limited on {routing} {method} "
+                        f"({limit_type}), retrying in {retry_after}s")
+                blocked = app if limit_type == "application" else meth
+                blocked.blocked_until = max(blocked.blocked_until,
+                                            now + retry_after)
+
+
+@dataclass
+class SqliteRateLimiter:
+    # Same budgets as RateLimiter, but kept in a SQLite file so that worker
+    # processes sharing an API key never overshoot together
+    path: str
+    # Keeps the budgets of different API keys apart
+    namespace: str
+    app_limits: str = "20:1,100:120"
+    conn: sqlite3.Connection = field(init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        self.conn = sqlite3.connect(self.path, timeout=60,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS limits (
+                scope TEXT PRIMARY KEY,
+                spec TEXT,
+                blocked_until REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS spent (
+                scope TEXT NOT NULL,
+                at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spent_scope ON spent (scope, at);
+        """)
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def scopes(self, routing: str, method: str) -> List[Tuple[str, str]]:
+        return [(f"{self.namespace}:{routing}", self.app_limits),
+                (f"{self.namespace}:{routing}:{method}", "")]
+
+    def limits(self, conn, scope: str, default: str):
+        row = conn.execute(
+            "SELECT spec, blocked_until FROM limits WHERE scope = ?",
+            (scope,)).fetchone()
+        spec, blocked_until = row if row else (None, 0.0)
+        return (parse_limits(spec or default), blocked_until)
+
+    def spent_since(self, conn, scope: str, since: float) -> int:
+        return conn.execute(
+            "SELECT COUNT(*) FROM spent WHERE scope = ? AND at > ?",
+            (scope, since)).fetchone()[0]
+
+    def nth_newest(self, conn, scope: str, since: float,
+                   n: int) -> Optional[float]:
+        # When the n-th newest token was spent, None with fewer than n
+        row = conn.execute("""
+            SELECT at FROM spent WHERE scope = ? AND at > ?
+            ORDER BY at DESC LIMIT 1 OFFSET ?
+        """, (scope, since, n - 1)).fetchone()
+        return row[0] if row else None
+
+    def reserve(self, routing: str, method: str) -> float:
+        with self.transaction() as conn:
+            now = time.time()
+            wait = 0.0
+            scopes = self.scopes(routing, method)
+            for scope, default in scopes:
+                limits, blocked_until = self.limits(conn, scope, default)
+                wait = max(wait, blocked_until - now)
+                for n, w in limits:
+                    # Only the token that frees up next is read, windows
+                    # can hold tens of thousands
+                    at = self.nth_newest(conn, scope, now - w - SLACK, n)
+                    if at is not None:
+                        wait = max(wait, at + w + SLACK - now)
+            if wait > 0:
+                return wait
+
+            conn.executemany("INSERT INTO spent VALUES (?, ?)",
+                             [(scope, now) for scope, _ in scopes])
+            return 0.0
+
+    def update(
+        self,
+        routing: str,
+        method: str,
+        status: int,
+        headers: Mapping[str, str],
+    ):
+        with self.transaction() as conn:
+            now = time.time()
+            (app, app_default), (meth, _) = self.scopes(routing, method)
+            for scope, default, limit_header, count_header in (
+                    (app, app_default, "X-App-Rate-Limit",
+                     "X-App-Rate-Limit-Count"),
+                    (meth, "", "X-Method-Rate-Limit",
+                     "X-Method-Rate-Limit-Count")):
+                spec = headers.get(limit_header)
+                if spec:
+                    conn.execute("""
+                        INSERT INTO limits (scope, spec) VALUES (?, ?)
+                        ON CONFLICT (scope) DO UPDATE SET spec = excluded.spec
+                    """, (scope, spec))
+                # Riot's count can be ahead of ours, e.g. after a restart
+                counts = dict((w, n) for n, w in
+                              parse_limits(headers.get(count_header)))
+                for n, w in self.limits(conn, scope, default)[0]:
+                    missing = counts.get(w, 0) - \
+                        self.spent_since(conn, scope, now - w - SLACK)
+                    conn.executemany("INSERT INTO spent VALUES (?, ?)",
+                                     [(scope, now)] * max(missing, 0))
+
+            if status == 429:
+                retry_after = float(headers.get("Retry-After", 1))
+                limit_type = headers.get("X-Rate-Limit-Type", "service")
+                warning(f"Rate limited on {routing} {method} "
+                        f"({limit_type}), retrying in {retry_after}s")
+                scope = app if limit_type == "application" else meth
+                conn.execute("""
+                    INSERT INTO limits (scope, blocked_until) VALUES (?, ?)
+                    ON CONFLICT (scope) DO UPDATE
+                    SET blocked_until = max(blocked_until,
+                                            excluded.blocked_until)
+                """, (scope, now + retry_after))
+
+            # Riot's longest windows are a few minutes. Pruning by scope
+            # stays on the (scope, at) index instead of scanning the table.
+            conn.executemany("DELETE FROM spent WHERE scope = ? AND at < ?",
+                             [(app, now - 3600), (meth, now - 3600)])
+
+
+@dataclass
+class KeyPool:
+    # API keys of one Riot application, each with its own rate limits
+    tokens: List[str]
+    app_limits: str = "20:1,100:120"
+    # Share rate budgets with other processes through this SQLite file
+    shared_path: Optional[str] = None
+    # A 403 can be down to the url rather than the key, so keys are only
+    # retired after 403s on this many different urls in a row
+    forbidden_limit: int = 3
+    limiters: Dict[str, Any] = field(default_factory=dict, init=False)
+    retired: Set[str] = field(default_factory=set, init=False)
+    forbidden: Dict[str, Set[str]] = field(default_factory=dict, init=False)
+    throttled: float = 0.0
+    _next: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        for token in self.tokens:
+            if self.shared_path:
+                namespace = hashlib.md5(token.encode("utf-8")).hexdigest()
+                self.limiters[token] = SqliteRateLimiter(
+                    self.shared_path, namespace, self.app_limits)
+            else:
+                self.limiters[token] = RateLimiter(app_limits=self.app_limits)
+
+    def active(self) -> List[str]:
+        with self._lock:
+            active = [t for t in self.tokens if t not in self.retired]
+            # Start with a different key each time to spread the load
+            self._next = (self._next + 1) % max(len(active), 1)
+            return active[self._next:] + active[:self._next]
+
+    def acquire(self, routing: str, method: str,
+                stop: Optional[threading.Event] = None) -> Optional[str]:
+        # Waits for a token, None when stop is set first
+        while True:
+            active = self.active()
+            if not active:
+                raise RuntimeError("All API keys have been retired")
+
+            waits = []
+            for token in active:
+                wait = self.limiters[token].reserve(routing, method)
+                if wait <= 0:
+                    return token
+                waits.append(wait)
+
+            wait = min(waits)
+            with self._lock:
+                self.throttled += wait
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return None
+
+    def update(
+        self,
+        token: str,
+        routing: str,
+        method: str,
+        status: int,
+        headers: Mapping[str, str],
+        url: Optional[str] = None,
+    ) -> bool:
+        # Returns whether the key is retired, i.e. worth retrying on another
+        with self._lock:
+            if status == 403:
+                urls = self.forbidden.setdefault(token, set())
+                urls.add(url)
+                retire = len(urls) >= self.forbidden_limit
+            else:
+                self.forbidden.pop(token, None)
+                retire = status == 401
+            if retire and token not in self.retired:
+                warning(f"Retiring API key ...{token[-4:]} "
+                        f"after a {status} response")
+                self.retired.add(token)
+            if status in (401, 403):
+                return token in self.retired
+        self.limiters[token].update(routing, method, status, headers)
+        return False
@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+from logging import info
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+import fcntl
+import json
+import os
+import threading
+
+
+@dataclass
+class MatchIndex:
+    path: str
+    # Called once to seed the index when the file does not exist yet
+    bootstrap: Callable[[], Iterable[str]] = lambda: []
+    ids: Optional[Set[str]] = field(default=None, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def load(self) -> Set[str]:
+        with self._lock:
+            if self.ids is not None:
+                return self.ids
+
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self.ids = set(line.strip() for line in f if line.strip())
+            else:
+                info(f"Building {self.path}")
+                self.ids = set(self.bootstrap())
+                with open(self.path, 'w') as f:
+                    f.writelines(f"{id}\n" for id in sorted(self.ids))
+
+            info(f"Loaded {len(self.ids)} match ids from {self.path}")
+            return self.ids
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.load()
+
+    def add(self, id: str):
+        self.update([id])
+
+    def update(self, new_ids: Iterable[str]):
+        ids = self.load()
+        with self._lock:
+            new_ids = [id for id in dict.fromkeys(new_ids) if id not in ids]
+            if not new_ids:
+                return
+            ids.update(new_ids)
+            with open(self.path, 'a') as f:
+                f.writelines(f"{id}\n" for id in new_ids)
+
+
+@dataclass
+class JsonState:
+    # A small mapping kept in memory and written back in one go. Saves only
+    # write the keys changed here on top of the file's current content, so
+    # several processes can share the file.
+    path: str
+    data: Dict[str, Any] = field(default_factory=dict, init=False)
+    dirty: Dict[str, Any] = field(default_factory=dict, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock,
+                                  init=False, repr=False)
+
+    def __post_init__(self):
+        self.data = self.read()
+        if self.data:
+            info(f"Loaded {len(self.data)} entries from {self.path}")
+
+    def read(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.loads(f.read())
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self.data[key] = value
+            self.dirty[key] = value
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            with open(f"{self.path}.lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.data = self.read() | self.dirty
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w') as f:
+                    json.dump(self.data, f)
+                os.replace(tmp, self.path)
+            info(f"Wrote {len(self.dirty)} entries to {self.path}")
+            self.dirty = {}